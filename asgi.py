@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI 部署入口, 路由与 server.py 完全相同
+
+    pip install uvicorn
+    uvicorn asgi:app --host 0.0.0.0 --port 13496
+
+Flask 视图 (含 SQLite 查询) 在有界的 app 线程池中执行, 池大小与 c.db 的连接池一致, 线程不会在取连接时排队;
+响应体与上传请求体的逐块读写放在单独的 io 线程池, 写给客户端则在事件循环中 await,
+慢速客户端下载大文件时只占用一个协程, 不占线程, /api 请求不会排在大文件下载之后
+"""
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from werkzeug.wsgi import FileWrapper
+
+import objgc
+import server
+from server import app as flask_app, c
+
+_END = object()
+
+
+class _ChunkedFileWrapper(FileWrapper):
+    """
+    作为 wsgi.file_wrapper: send_file 默认按 8KB 读文件, 这里放大到 c.obj_chunk_size, 减少线程池往返
+    """
+    def __init__(self, file, buffer_size: int = 8192):
+        super().__init__(file, max(buffer_size, c.obj_chunk_size))
+
+
+class _RequestBody:
+    """
+    wsgi.input: 在 app 线程中阻塞读取, 由事件循环中的 receive() 提供数据
+    """
+    def __init__(self, receive, loop: asyncio.AbstractEventLoop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more = True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._more = False
+            return
+        self._buffer += message.get('body', b'')
+        self._more = message.get('more_body', False)
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            while self._more:
+                self._fill()
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            return data
+        while len(self._buffer) < size and self._more:
+            self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        while b'\n' not in self._buffer and self._more and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+def _environ(scope, body: _RequestBody) -> dict:
+    host = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': host[0],
+        'SERVER_PORT': str(host[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': _ChunkedFileWrapper,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    if 'CONTENT_LENGTH' not in environ:
+        # ASGI 服务器已解开 chunked 编码, 读到 more_body=False 即结束
+        environ['wsgi.input_terminated'] = True
+    return environ
+
+
+class ASGIApp:
+    def __init__(self, wsgi_app, app_threads: Optional[int] = None, io_threads: int = 32):
+        self.wsgi_app = wsgi_app
+        self.app_threads = app_threads or c.db.pool_size
+        self.io_threads = io_threads
+        self.app_pool = None
+        self.io_pool = None
+
+    def _start(self):
+        if self.app_pool is None:
+            self.app_pool = ThreadPoolExecutor(self.app_threads, thread_name_prefix='asgi-app')
+            self.io_pool = ThreadPoolExecutor(self.io_threads, thread_name_prefix='asgi-io')
+            if c.gc_interval and c.gc_thread is None:
+                c.gc_thread = objgc.GCThread(c.db, c.objs, c.gc_interval, c.gc_grace)
+                c.gc_thread.start()
+
+    def _shutdown(self):
+        if c.gc_thread is not None:
+            c.gc_thread.stop()
+        if self.app_pool is not None:
+            self.app_pool.shutdown(wait=True)
+            self.io_pool.shutdown(wait=True)
+            self.app_pool = self.io_pool = None
+        c.db.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                c.db.init_db_once(server.INIT_LOCK_PATH)
+                server.warm_caches()
+                self._start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _call_app(self, environ, loop, send):
+        """
+        在 app 线程中执行视图并取出第一块响应体, 普通 API 响应只需这一次线程切换
+        """
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return write
+
+        def write(data):
+            # 旧式 WSGI write(), Flask 不使用, 仅为完整性
+            if not started.get('sent'):
+                asyncio.run_coroutine_threadsafe(self._send_start(send, started), loop).result()
+            asyncio.run_coroutine_threadsafe(send({'type': 'http.response.body', 'body': data, 'more_body': True}), loop).result()
+
+        iterable = self.wsgi_app(environ, start_response)
+        iterator = iter(iterable)
+        first = next(iterator, _END)
+        return started, iterable, iterator, first
+
+    @staticmethod
+    async def _send_start(send, started):
+        started['sent'] = True
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        self._start()
+        loop = asyncio.get_running_loop()
+        environ = _environ(scope, _RequestBody(receive, loop))
+        started, iterable, iterator, chunk = await loop.run_in_executor(self.app_pool, self._call_app, environ, loop, send)
+        try:
+            if not started.get('sent'):
+                await self._send_start(send, started)
+            while chunk is not _END:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.io_pool, next, iterator, _END)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.io_pool, iterable.close)
+
+
+app = ASGIApp(flask_app)
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准脚本, 每个基准在临时目录中建库运行, 不会触碰 ./data
+
+python bench.py -release     提交 release 的事务提交次数与延迟
+python bench.py -projects    项目列表 / owner 列表在不同 release 数量下的延迟
+python bench.py -pages       offset 分页与游标分页在第 1 页和第 10000 页的延迟
+python bench.py -layout [n]  n 个对象 (默认 1000000) 时 flat 与 sharded 布局的 stat/open 延迟
+python bench.py -checkfile   库中 100 万个 hash 时, /checkFile 查询 100 / 1 万 / 100 万个 hash 的延迟
+python bench.py -delta       只改动少量文件时, 完整提交与增量提交的请求体大小与延迟
+python bench.py -history     一个项目连续提交 500 次 (每次改动少量文件与一个工程文件) 后的库文件大小
+python bench.py -merge       合并两个各有 1 万 / 5 万个文件、一成路径不同的 release 的延迟
+python bench.py -diff        两个 10 万个文件的 release 之间改动 10 / 1000 个文件时的 diff 延迟
+python bench.py -reverse     1000 个提交 x 1 万个文件 (1000 万条引用) 时, 按对象查 release 与按路径查历史的每页延迟
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+
+import db as db_module
+import objstore
+import cache
+
+
+class CountingDB(db_module.DB):
+    """
+    统计每个连接上实际执行的 COMMIT 次数
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, trace_callback=self._trace, **kwargs)
+        self.commits = 0
+
+    def _trace(self, statement):
+        if statement.strip().upper().startswith('COMMIT'):
+            self.commits += 1
+
+
+def fake_hash(s):
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def make_filehashmap(n, salt=''):
+    return {f'snapshot/node{i}/out.json': fake_hash(f'{salt}{i}') for i in range(n)}
+
+
+def report(name, seconds, **extra):
+    fields = ' '.join(f'{k}={v}' for k, v in extra.items())
+    print(f'{name:<40} {seconds * 1000:10.1f} ms  {fields}')
+
+
+def bench_release(sizes=(1000, 10000, 50000)):
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = CountingDB(os.path.join(tmp, 'data.db'))
+            db.init_db()
+            filehashmap = make_filehashmap(n)
+            db.add_filehash(list(filehashmap.values()))
+
+            db.commits = 0
+            t0 = time.perf_counter()
+            db.submit_release('g1', 'proj', 'owner', 'author', filehashmap, {'a.json': {}}, '2024-01-01 00:00:00')
+            report(f'submit_release new files={n}', time.perf_counter() - t0, commits=db.commits)
+
+            db.commits = 0
+            t0 = time.perf_counter()
+            db.submit_release('g1', 'proj', 'owner', 'author', filehashmap, {'a.json': {}}, '2024-01-01 00:00:01')
+            report(f'submit_release overwrite files={n}', time.perf_counter() - t0, commits=db.commits)
+
+            db.commits = 0
+            t0 = time.perf_counter()
+            db.delete_release('g1', 'proj', 'owner')
+            report(f'delete_release files={n}', time.perf_counter() - t0, commits=db.commits)
+            db.close()
+
+
+def seed_releases(db, n, projects=1000, files=1):
+    """
+    直接批量插入 n 个 release, 平均分布在若干项目上
+    """
+    filehashmap = make_filehashmap(files)
+    db.add_filehash(list(filehashmap.values()))
+    with db._transaction() as conn:
+        for i in range(n):
+            db._insert_release(
+                conn, f'g{i}', f'proj{i % projects}', f'owner{i % projects % 37}', 'author',
+                filehashmap, {}, f'2024-01-01 00:00:{i:08d}'
+            )
+
+
+def timed(fn, repeat=20):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat
+
+
+def bench_projects(sizes=(1000, 10000, 100000)):
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = db_module.DB(os.path.join(tmp, 'data.db'))
+            db.init_db()
+            seed_releases(db, n)
+            report(f'list_projects_global page1 releases={n}', timed(lambda: db.list_projects_global(0, 20)))
+            report(f'count_projects_global releases={n}', timed(db.count_projects_global))
+            report(f'list_owners releases={n}', timed(db.list_owners))
+            db.close()
+
+
+def bench_pages(size=20, deep_page=10000):
+    n = size * (deep_page + 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_module.DB(os.path.join(tmp, 'data.db'))
+        db.init_db()
+        seed_releases(db, n, projects=1)
+        deep_offset = size * (deep_page - 1)
+        # 第 deep_page 页的游标即第 deep_offset 行之前那一行的 (time, id)
+        with db._connection() as conn:
+            row = conn.execute(
+                "SELECT time, id FROM githashdb WHERE owner = ? AND projectname = ? ORDER BY time DESC, id DESC LIMIT 1 OFFSET ?",
+                ('owner0', 'proj0', deep_offset - 1)
+            ).fetchone()
+        deep_key = (row['time'], row['id'])
+
+        report(f'offset page=1 commits={n}', timed(lambda: db.list_commits('owner0', 'proj0', 0, size)))
+        report(f'offset page={deep_page} commits={n}', timed(lambda: db.list_commits('owner0', 'proj0', deep_offset, size)))
+        report(f'cursor page=1 commits={n}', timed(lambda: db.list_commits_after('owner0', 'proj0', None, size)))
+        report(f'cursor page={deep_page} commits={n}', timed(lambda: db.list_commits_after('owner0', 'proj0', deep_key, size)))
+        db.close()
+
+
+def bench_layout(n=1000000, samples=20000):
+    import random
+    hashes = [fake_hash(str(i)) for i in range(n)]
+    rng = random.Random(0)
+    hits = rng.sample(hashes, min(samples, n))
+    misses = [fake_hash(f'miss{i}') for i in range(len(hits))]
+    for layout in ('flat', 'sharded'):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = objstore.ObjectStore(tmp, layout=layout, fallback=())
+            t0 = time.perf_counter()
+            for hashk in hashes:
+                path = store.path(hashk)
+                if layout != 'flat':
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(b'x')
+            report(f'{layout} create objects={n}', time.perf_counter() - t0)
+            # 丢弃 dentry/inode 缓存需要 root, 这里测的是热缓存下的查找开销
+            t0 = time.perf_counter()
+            for hashk in hits:
+                os.stat(store.path(hashk))
+            report(f'{layout} stat hit x{len(hits)}', time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            for hashk in misses:
+                store.locate(hashk)
+            report(f'{layout} locate miss x{len(misses)}', time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            for hashk in hits:
+                with open(store.path(hashk), 'rb') as f:
+                    f.read()
+            report(f'{layout} open+read x{len(hits)}', time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            count = sum(1 for _ in store.iter_objects())
+            report(f'{layout} list all objects={count}', time.perf_counter() - t0)
+
+
+def legacy_find_matching_filehash(db, input_list):
+    # 改为分批之前的实现: 一条 IN 语句, 每个 hash 一个参数
+    with db._connection() as conn:
+        placeholders = ','.join(['?' for _ in input_list])
+        return [row[0] for row in conn.execute(f"SELECT filehash FROM filehashdb WHERE filehash IN ({placeholders})", input_list)]
+
+
+def bench_checkfile(known=1000000, sizes=(100, 10000, 1000000)):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_module.DB(os.path.join(tmp, 'data.db'))
+        db.init_db()
+        hashes = [fake_hash(str(i)) for i in range(known)]
+        for i in range(0, known, 100000):
+            db.add_filehash(hashes[i:i + 100000])
+        known_filter = cache.KnownHashFilter(db)
+        t0 = time.perf_counter()
+        known_filter.refresh()
+        report(f'bloom build known={known}', time.perf_counter() - t0, bytes=len(known_filter.bloom._array))
+        for n in sizes:
+            for label, query in (('half known', hashes[:n // 2] + [fake_hash(f'new{i}') for i in range(n - n // 2)]),
+                                 ('all new', [fake_hash(f'new{i}') for i in range(n)])):
+                repeat = 1 if n >= 100000 else 5
+                try:
+                    seconds = timed(lambda: legacy_find_matching_filehash(db, query), repeat)
+                    report(f'checkFile single IN {label} n={n}', seconds)
+                except Exception as e:
+                    print(f'checkFile single IN {label} n={n}'.ljust(40), 'failed:', e)
+                report(f'checkFile batched {label} n={n}', timed(lambda: db.find_matching_filehash(query), repeat))
+                report(f'checkFile bloom {label} n={n}', timed(lambda: known_filter.find_matching(query), repeat))
+        db.close()
+
+
+def bench_delta(sizes=(1000, 10000, 50000), changed=10):
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = db_module.DB(os.path.join(tmp, 'data.db'))
+            db.init_db()
+            filehashmap = make_filehashmap(n)
+            projectfile = {'a.json': {'nodes': [{'id': i, 'name': f'node{i}'} for i in range(n // 10)]}}
+            db.add_filehash(list(filehashmap.values()) + [fake_hash(f'changed{i}') for i in range(changed)])
+            db.submit_release('g0', 'proj', 'owner', 'author', filehashmap, projectfile, '2024-01-01 00:00:00')
+
+            patch = {f'snapshot/node{i}/out.json': fake_hash(f'changed{i}') for i in range(changed)}
+            full = dict(filehashmap, **patch)
+            body = json.dumps({'filehashmap': full, 'projectfile': projectfile})
+            t0 = time.perf_counter()
+            db.submit_release('g1', 'proj', 'owner', 'author', full, projectfile, '2024-01-01 00:00:01')
+            report(f'submit full files={n} changed={changed}', time.perf_counter() - t0, request_bytes=len(body))
+
+            body = json.dumps({'parent': 'g0', 'filehashmap': patch, 'projectfile': {}})
+            t0 = time.perf_counter()
+            db.submit_release_delta('g2', 'proj', 'owner', 'author', 'g0', patch, {}, '2024-01-01 00:00:02')
+            report(f'submit delta files={n} changed={changed}', time.perf_counter() - t0, request_bytes=len(body))
+            db.close()
+
+
+def db_file_bytes(db):
+    with db._connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+
+def bench_history(commits=500, files=10000, changed=10):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_module.DB(os.path.join(tmp, 'data.db'))
+        db.init_db()
+        filehashmap = make_filehashmap(files)
+        projectfile = {f'{name}.json': {'nodes': [{'id': i, 'name': f'{name}{i}'} for i in range(500)]} for name in ('a', 'b', 'c', 'd')}
+        db.add_filehash(list(filehashmap.values()))
+        inline_bytes = 0
+        t0 = time.perf_counter()
+        for i in range(commits):
+            patch = {f'snapshot/node{(i * changed + j) % files}/out.json': fake_hash(f'c{i}-{j}') for j in range(changed)}
+            db.add_filehash(list(patch.values()))
+            filehashmap.update(patch)
+            projectfile['a.json']['nodes'][i % 500]['name'] = f'renamed{i}'
+            db.submit_release(f'g{i}', 'proj', 'owner', 'author', filehashmap, projectfile, f'2024-01-01 00:{i // 60:02d}:{i % 60:02d}')
+            # 旧版每个提交在 githashdb 行内存放完整的 filehashmap 与 projectfile
+            inline_bytes += len(json.dumps(filehashmap, ensure_ascii=False)) + len(json.dumps(projectfile, ensure_ascii=False))
+        report(f'submit {commits} commits files={files}', time.perf_counter() - t0,
+               db_bytes=db_file_bytes(db), inline_json_bytes=inline_bytes)
+        t0 = time.perf_counter()
+        db.find_exact_match(f'g{commits - 1}', 'proj', 'owner')
+        report('find_exact_match latest', time.perf_counter() - t0)
+        db.close()
+
+
+def bench_merge(sizes=(10000, 50000)):
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = db_module.DB(os.path.join(tmp, 'data.db'))
+            db.init_db()
+            local = make_filehashmap(n)
+            remote = dict(local)
+            for i in range(0, n, 10):
+                remote[f'snapshot/node{i}/out.json'] = fake_hash(f'remote{i}')
+            db.add_filehash(list(local.values()) + list(remote.values()))
+            db.submit_release('g1', 'proj', 'owner', 'author', local, {'a.json': {}}, '2024-01-01 00:00:00')
+            db.submit_release('g2', 'proj', 'owner', 'author', remote, {'a.json': {}}, '2024-01-01 00:00:01')
+            sources = [('owner', 'proj', 'g1'), ('owner', 'proj', 'g2')]
+            report(f'merge_releases files={n}', timed(lambda: db.merge_releases(sources), 5))
+            t0 = time.perf_counter()
+            merged = db.submit_merge(sources, 'g3', 'proj', 'owner', 'author', '2024-01-01 00:00:02')
+            report(f'submit_merge files={n}', time.perf_counter() - t0, conflicts=len(merged['conflicts']))
+            db.close()
+
+
+def bench_diff(n=100000, changes=(10, 1000)):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_module.DB(os.path.join(tmp, 'data.db'))
+        db.init_db()
+        base = make_filehashmap(n)
+        db.add_filehash(list(base.values()))
+        db.submit_release('g0', 'proj', 'owner', 'author', base, {'a.json': {'nodes': {}}}, '2024-01-01 00:00:00')
+        for i, changed in enumerate(changes, start=1):
+            filehashmap = dict(base)
+            for j in range(changed):
+                filehashmap[f'snapshot/node{j * (n // changed)}/out.json'] = fake_hash(f'changed{j}')
+            db.add_filehash(list(filehashmap.values()))
+            db.submit_release(f'g{i}', 'proj', 'owner', 'author', filehashmap, {'a.json': {'nodes': {'n': 1}}}, f'2024-01-01 00:00:0{i}')
+            from_id = db.find_exact_match('g0', 'proj', 'owner', fields=['id'])[0]['id']
+            to_id = db.find_exact_match(f'g{i}', 'proj', 'owner', fields=['id'])[0]['id']
+            diff = db.diff_releases(from_id, to_id)
+            report(f'diff_releases files={n} changed={changed}', timed(lambda: db.diff_releases(from_id, to_id), 5), changed_paths=len(diff['changed']))
+        db.close()
+
+
+def bench_reverse(commits=1000, files=10000, changed=10):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = db_module.DB(os.path.join(tmp, 'data.db'))
+        db.init_db()
+        filehashmap = make_filehashmap(files)
+        # 1% 的路径是同一个文件 (例如空快照), 每个提交中被引用 100 次
+        shared = fake_hash('shared')
+        for i in range(0, files, 100):
+            filehashmap[f'snapshot/node{i}/out.json'] = shared
+        db.add_filehash(list(filehashmap.values()))
+        for i in range(commits):
+            patch = {f'snapshot/node{(i * changed + j) % files + 1}/out.json': fake_hash(f'c{i}-{j}') for j in range(changed)}
+            db.add_filehash(list(patch.values()))
+            filehashmap.update(patch)
+            db.submit_release(f'g{i}', 'proj', 'owner', 'author', filehashmap, {}, f'2024-01-01 {i // 3600:02d}:{i // 60 % 60:02d}:{i % 60:02d}')
+        report(f'seeded references={commits * files}', 0)
+        for label, filehash in (('unique', fake_hash('c500-3')), ('shared', shared)):
+            page, next_key = db.list_filehash_releases(filehash, None, 20)
+            report(f'filehash releases {label} first page', timed(lambda: db.list_filehash_releases(filehash, None, 20), 5))
+            if next_key:
+                report(f'filehash releases {label} next page', timed(lambda: db.list_filehash_releases(filehash, next_key, 20), 5))
+        path = 'snapshot/node5001/out.json'
+        report('path history page', timed(lambda: db.list_path_history('owner', 'proj', path, None, 20), 5))
+        report('path history changes page', timed(lambda: db.list_path_history('owner', 'proj', path, None, 20, changes_only=True), 5),
+               changes=len(db.list_path_history('owner', 'proj', path, None, 20, changes_only=True)[0]))
+        db.close()
+
+
+if __name__ == '__main__':
+    if '-release' in sys.argv:
+        bench_release()
+    if '-projects' in sys.argv:
+        bench_projects()
+    if '-pages' in sys.argv:
+        bench_pages()
+    if '-layout' in sys.argv:
+        i = sys.argv.index('-layout')
+        n = int(sys.argv[i + 1]) if i + 1 < len(sys.argv) else 1000000
+        bench_layout(n)
+    if '-checkfile' in sys.argv:
+        bench_checkfile()
+    if '-delta' in sys.argv:
+        bench_delta()
+    if '-history' in sys.argv:
+        bench_history()
+    if '-merge' in sys.argv:
+        bench_merge()
+    if '-diff' in sys.argv:
+        bench_diff()
+    if '-reverse' in sys.argv:
+        bench_reverse()
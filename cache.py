@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+进程内的 LRU 缓存, 按估算的内存占用限制总大小
+"""
+
+import os
+import sys
+import json
+import math
+import mmap
+import struct
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: 只有单进程部署, 不需要跨进程加锁
+    fcntl = None
+
+
+def sizeof_str_map(m: Dict[str, str]) -> int:
+    """
+    估算 {str: str} 字典 (例如 filehashmap) 占用的字节数
+    """
+    return sys.getsizeof(m) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in m.items())
+
+
+def sizeof_json(value: Any) -> int:
+    """
+    按 JSON 序列化后的长度估算, 用于嵌套的 API 响应
+    """
+    return sys.getsizeof(json.dumps(value, ensure_ascii=False))
+
+
+def key_hash(key: Hashable) -> bytes:
+    """
+    跨进程一致的 8 字节键散列 (repr 对 str / 元组在各进程相同)
+    """
+    return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).digest()
+
+
+class SharedInvalidations:
+    """
+    多个 worker 进程共享的失效记录: 映射到文件的 8 字节计数 + slots 个最近失效键的散列组成的环
+    publish() 在文件锁下把键散列写入环中下一格再增加计数; 各进程记住读到的计数,
+    poll() 发现计数变化时读出期间新增的键散列, 只删除本进程中对应的条目
+    落后超过 slots 次 (环已被覆盖) 时无法知道丢了哪些键, 返回 None, 调用方整体清空
+    """
+    _HEADER = struct.Struct('<Q')
+
+    def __init__(self, path: str, slots: int = 4096):
+        self.path = path
+        self.slots = slots
+        self.size = self._HEADER.size + 8 * slots
+        self._fd = None
+        self._pid = None
+        with self._locked() as fd:
+            if os.fstat(fd).st_size != self.size:
+                # 新文件或旧格式 (以及不同的 slots): 从计数 0 开始
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            self._map = mmap.mmap(fd, self.size)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # fork 出的子进程与父进程共用打开的文件, flock 互不排斥, 因此每个进程各自打开一次
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        if fcntl is None:
+            yield self._fd
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield self._fd
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def generation(self) -> int:
+        return self._HEADER.unpack_from(self._map, 0)[0]
+
+    def _slot(self, generation: int) -> int:
+        return self._HEADER.size + 8 * (generation % self.slots)
+
+    def poll(self, seen: int) -> Tuple[int, Optional[List[bytes]]]:
+        """
+        返回 (当前计数, seen 之后失效的键散列); 读取时落后超过一圈则第二项为 None
+        计数未变时只是一次内存读取
+        """
+        generation = self.generation()
+        if generation == seen:
+            return generation, []
+        if generation < seen or generation - seen > self.slots:
+            return generation, None
+        hashes = [self._map[self._slot(g):self._slot(g) + 8] for g in range(seen + 1, generation + 1)]
+        # 读取期间被其他进程继续写入而覆盖了刚读的格子
+        if self.generation() - seen > self.slots:
+            return generation, None
+        return generation, hashes
+
+    def publish(self, seen: int, key: Hashable) -> Tuple[int, Optional[List[bytes]]]:
+        """
+        记录 key 失效; 同时返回 seen 之后其他进程的失效 (同 poll), 返回的计数已包含本次
+        """
+        with self._locked():
+            generation, hashes = self.poll(seen)
+            generation += 1
+            self._map[self._slot(generation):self._slot(generation) + 8] = key_hash(key)
+            self._HEADER.pack_into(self._map, 0, generation)
+        return generation, hashes
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存, 条目总大小不超过 max_bytes, 单个超过 max_bytes 的值不缓存
+    get_or_load 在加载期间若发生 invalidate, 加载结果不写入缓存, 避免把失效前读到的旧值放回去
+    shared 不为空时 (多 worker 部署), 任一进程 invalidate 的键会在其他进程下一次访问缓存时被删除:
+    每次访问多一次共享计数的内存读取, 计数变化时按键散列删除对应条目; invalidate 多一次文件锁;
+    某个进程空闲期间累计超过 shared.slots 次失效时, 该进程下一次访问会整体清空缓存
+    """
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = sys.getsizeof, shared: Optional[SharedInvalidations] = None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.shared = shared
+        self._shared_seen = shared.generation() if shared is not None else None
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        # 键散列 -> 键, 只在 shared 时维护, 用于按其他进程发来的散列删除条目
+        self._hashes: Dict[bytes, Hashable] = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _apply_shared(self, generation: int, hashes: Optional[List[bytes]]):
+        # 调用方持有 self._lock
+        self._shared_seen = generation
+        if hashes is None:
+            self._version += 1
+            self._clear()
+            return
+        if hashes:
+            self._version += 1
+            for h in hashes:
+                key = self._hashes.get(h)
+                if key is not None:
+                    self._pop(key)
+
+    def _sync_shared(self):
+        # 调用方持有 self._lock
+        if self.shared is not None:
+            self._apply_shared(*self.shared.poll(self._shared_seen))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            self._sync_shared()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, version: Optional[int] = None):
+        size = self.sizeof(value)
+        with self._lock:
+            self._sync_shared()
+            if version is not None and version != self._version:
+                return
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            if self.shared is not None:
+                self._hashes[key_hash(key)] = key
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Optional[Any]]) -> Optional[Any]:
+        """
+        未命中时调用 load() 并缓存结果; load() 返回 None 表示不存在, 不缓存
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        version = self._version
+        value = load()
+        if value is not None:
+            self.put(key, value, version)
+        return value
+
+    def _pop(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+            if self.shared is not None:
+                self._hashes.pop(key_hash(key), None)
+
+    def _clear(self):
+        self._entries.clear()
+        self._hashes.clear()
+        self._bytes = 0
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._version += 1
+            self._pop(key)
+            if self.shared is not None:
+                self._apply_shared(*self.shared.publish(self._shared_seen, key))
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+
+class BloomFilter:
+    """
+    单散列函数的 Bloom filter: 不在其中的一定不存在, 在其中的可能存在 (误判率约 error_rate)
+    CPython 中每多一个散列函数的开销比省下的一次 SQLite 索引查找还大, 因此用 k=1, 以内存换速度:
+    每个条目约 1/error_rate 位, error_rate=0.02 时一百万个 hash 约 6MB
+    hash 为十六进制串时直接取前 16 位作散列值, 否则用 blake2b
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.02):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(64, int(-capacity / math.log(1 - error_rate)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _position(self, key: str) -> int:
+        try:
+            h = int(key[:16], 16)
+        except ValueError:
+            h = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        return h % self.bits
+
+    def add(self, key: str):
+        pos = self._position(key)
+        self._array[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        pos = self._position(key)
+        return bool(self._array[pos >> 3] >> (pos & 7) & 1)
+
+
+class KnownHashFilter:
+    """
+    filehashdb 中已有 hash 的 Bloom filter, /checkFile 先用它排除肯定不存在的 hash, 只对可能存在的查库
+    每次使用前按自增 id 增量读入新行 (包括其他 worker 进程写入的), 因此不会把存在的 hash 判为不存在;
+    删除 (GC) 不反映到 filter 中, 只会多一次数据库确认
+    条目数超过容量时按两倍容量重建
+    """
+    BATCH = 100000
+
+    def __init__(self, db, capacity: int = 1 << 20, error_rate: float = 0.02):
+        self.db = db
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._reset(capacity)
+
+    def _reset(self, capacity: int):
+        self.bloom = BloomFilter(capacity, self.error_rate)
+        self.last_id = 0
+
+    def refresh(self):
+        with self._lock:
+            while True:
+                rows = self.db.list_filehash_since(self.last_id, self.BATCH)
+                if not rows:
+                    return
+                if self.bloom.count + len(rows) > self.bloom.capacity:
+                    self._reset(self.bloom.capacity * 2)
+                    continue
+                for _, filehash in rows:
+                    self.bloom.add(filehash)
+                self.last_id = rows[-1][0]
+
+    def find_matching(self, input_list: List[str]) -> List[str]:
+        """
+        与 db.find_matching_filehash 结果相同
+        """
+        self.refresh()
+        bloom = self.bloom
+        return self.db.find_matching_filehash([h for h in set(input_list) if h in bloom])
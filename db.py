@@ -1,6 +1,21 @@
+import os
+import zlib
 import sqlite3
 import json
-from typing import List, Dict, Any
+import hashlib
+import queue
+import threading
+import heapq
+import itertools
+from contextlib import contextmanager
+import re
+from typing import List, Dict, Any, Tuple, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 flock, 只能单进程启动
+    fcntl = None
 
 def _decode_json_field(row_dict: Dict[str, Any], key: str):
     val = row_dict.get(key)
@@ -8,14 +23,257 @@ def _decode_json_field(row_dict: Dict[str, Any], key: str):
         row_dict[key] = json.loads(val)
     return row_dict
 
+def _decode_release(row_dict: Dict[str, Any]) -> Dict[str, Any]:
+    for key in ('filehashmap', 'projectfile', 'parents'):
+        _decode_json_field(row_dict, key)
+    return row_dict
+
+# 连接级别的 pragma, 每个新连接建立时执行一次
+# WAL 让读者与唯一的写者互不阻塞; synchronous=NORMAL 在 WAL 下只在 checkpoint 时 fsync
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",       # 64MB 页缓存
+    "PRAGMA mmap_size=268435456",     # 256MB 内存映射读
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+# githashdb 中可按需投影的字段, filehashmap / projectfile 为大字段
+RELEASE_FIELDS = ('id', 'githash', 'projectname', 'owner', 'author', 'filehashmap', 'projectfile', 'time', 'parents')
+
+def _release_columns(fields: Optional[List[str]], default: Tuple[str, ...]) -> List[str]:
+    """
+    fields 为 None 时返回 default; 否则校验字段名并按 RELEASE_FIELDS 的顺序返回
+    """
+    if fields is None:
+        return list(default)
+    unknown = set(fields) - set(RELEASE_FIELDS)
+    if unknown:
+        raise ValueError(f'unknown fields: {",".join(sorted(unknown))}')
+    return [f for f in RELEASE_FIELDS if f in fields]
+
+# filehashmap / projectfile 不在 githashdb 行内, 由 release_doc 引用的 jsondoc 拼出
+# 相关子查询只读本 release 的若干行, 不请求这两个字段时不执行
+_RELEASE_EXPRS = {
+    'filehashmap': """(
+        SELECT json_group_object(m.key, m.value) FROM (
+            SELECT d.body FROM release_doc rd JOIN jsondoc d ON d.id = rd.doc_id
+            WHERE rd.release_id = githashdb.id AND rd.kind = 'filehashmap'
+            ORDER BY rd.key
+        ) c, json_each(c.body) m
+    )""",
+    'projectfile': """(
+        SELECT json_group_object(rd.key, json(d.body)) FROM release_doc rd JOIN jsondoc d ON d.id = rd.doc_id
+        WHERE rd.release_id = githashdb.id AND rd.kind = 'projectfile'
+    )""",
+}
+
+def _release_select(columns: List[str]) -> str:
+    return ', '.join(f'{_RELEASE_EXPRS[col]} AS {col}' if col in _RELEASE_EXPRS else col for col in columns)
+
+# filehashmap 按排序后的路径切块, 路径的 crc32 低位全为 0 处断开, 平均每块 _CHUNK_MASK+1 个路径
+# 断点只由路径本身决定, 改动 / 增删少量文件只影响所在的块, 其余块与上一个提交相同, 不重复存储
+_CHUNK_MASK = 127
+
+def _dumps_doc(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def _doc_hash(kind: str, body: str) -> str:
+    return hashlib.sha256(f'{kind}\0{body}'.encode('utf-8')).hexdigest()
+
+def _chunk_filehashmap(filehashmap: Dict[str, str]) -> List[Tuple[str, str]]:
+    """
+    返回 [(块内第一个路径, 块的 JSON)], 按路径排序
+    """
+    chunks = []
+    chunk = {}
+    for path in sorted(filehashmap):
+        chunk[path] = filehashmap[path]
+        if zlib.crc32(path.encode('utf-8')) & _CHUNK_MASK == 0:
+            chunks.append((next(iter(chunk)), _dumps_doc(chunk)))
+            chunk = {}
+    if chunk:
+        chunks.append((next(iter(chunk)), _dumps_doc(chunk)))
+    return chunks
+
+def _json_key_diff(old: Any, new: Any, prefix: str = '') -> Dict[str, List[str]]:
+    """
+    两个 JSON 文档的键差异, 对象逐层比较, 键路径以 / 连接; 数组与标量整体比较
+    """
+    diff = {'added': [], 'removed': [], 'changed': []}
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        if old != new:
+            diff['changed'].append(prefix or '/')
+        return diff
+    for key in old.keys() - new.keys():
+        diff['removed'].append(f'{prefix}/{key}')
+    for key in new.keys() - old.keys():
+        diff['added'].append(f'{prefix}/{key}')
+    for key in old.keys() & new.keys():
+        if old[key] != new[key]:
+            sub = _json_key_diff(old[key], new[key], f'{prefix}/{key}')
+            for k in diff:
+                diff[k].extend(sub[k])
+    for k in diff:
+        diff[k].sort()
+    return diff
+
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+# SCAN <表或别名> [后缀], 3.36 之前写作 SCAN TABLE <表>; USING [COVERING] INDEX, 虚表, 常量行与
+# 子查询结果 (3.36 之前写作 SCAN SUBQUERY n) 的扫描不算全表扫描
+_TABLE_SCAN = re.compile(
+    r'^SCAN (?!CONSTANT ROW$|SUBQUERY \d+$)(?:TABLE )?(\S+)(?!.*\bUSING (?:COVERING )?INDEX\b)(?!.*\bVIRTUAL TABLE\b)'
+)
+# 物化 / 协程子查询的结果集, 扫描它们不是扫描真实表 (子查询自身的计划另有行)
+_SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\S+)$')
+
+# list_path_history(changes_only) 单次调用最多扫描的提交数, 超过时返回不足一页的结果与下一页游标
+PATH_HISTORY_MAX_SCAN = 10000
+
+# list_commits 默认返回的字段
+_COMMIT_FIELDS = ('githash', 'projectname', 'owner', 'author', 'filehashmap', 'projectfile', 'time', 'parents')
+
 class DB:
-    def __init__(self, db_path: str = "./data/data.db"):
+    def __init__(self, db_path: str = "./data/data.db", pool_size: int = 16, busy_timeout: float = 30.0, cached_statements: int = 256, trace_callback=None):
         
         self.db_path = db_path
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        # 调试/基准用: 新建连接时挂上 sqlite3 trace 回调, 收到展开参数后的 SQL
+        self.trace_callback = trace_callback
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._pool_lock = threading.Lock()
+        self._pid = os.getpid()
 
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
+    def _new_connection(self) -> sqlite3.Connection:
+        # check_same_thread=False: 连接在池中被不同的请求线程轮流使用, 但同一时刻只归一个线程
+        # isolation_level=None: 关闭 sqlite3 模块的隐式事务, 写操作统一经 _transaction 显式开启
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self.cached_statements,
+        )
         conn.row_factory = sqlite3.Row
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if self.trace_callback is not None:
+            conn.set_trace_callback(self.trace_callback)
+        return conn
+
+    def _check_fork(self):
+        """
+        fork 出的子进程不能使用父进程打开的 SQLite 连接: 发现 pid 变化时丢弃继承来的池 (不关闭, 也不触碰其中连接)
+        锁也可能在 fork 时处于被持有状态, 一并重建
+        """
+        if self._pid != os.getpid():
+            self._pool = queue.LifoQueue(maxsize=self.pool_size)
+            self._pool_lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def _acquire(self) -> sqlite3.Connection:
+        self._check_fork()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+    def _release(self, conn: sqlite3.Connection):
+        if self._pid != os.getpid():
+            return
+        if conn.in_transaction:
+            # 异常退出时未提交的事务不能带回池中
+            conn.rollback()
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def _connection(self):
+        """
+        从连接池借出一个长连接, 用完归还
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        借出连接并开启 BEGIN IMMEDIATE 写事务, 正常退出时 COMMIT, 异常时 ROLLBACK
+        IMMEDIATE 在事务开始时就拿写锁, 避免读后升级写锁时的 SQLITE_BUSY
+        """
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        """
+        关闭池中所有空闲连接
+        """
+        self._check_fork()
+        with self._pool_lock:
+            while True:
+                try:
+                    conn = self._pool.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+
+    # schema 迁移步骤, 第 i 项把 PRAGMA user_version 从 i 升到 i+1
+    # 只能在末尾追加; 每一步都要能在 user_version 记录之前建出的库上重复执行
+    _MIGRATIONS = (
+        '_migrate_v1_base_tables',
+        '_migrate_v2_fileref',
+        '_migrate_v3_githash_indexes',
+        '_migrate_v4_projects_summary',
+        '_migrate_v5_keyset_index',
+        '_migrate_v6_release_parents',
+        '_migrate_v7_content_addressed_docs',
+        '_migrate_v8_doc_kind_hash',
+    )
+
+    def init_db(self):
+        """
+        建表并执行尚未应用的 schema 迁移, 全部迁移在同一个写事务内完成
+        """
+        with self._transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > len(self._MIGRATIONS):
+                raise RuntimeError(f'database schema version {version} is newer than this server ({len(self._MIGRATIONS)})')
+            for target, name in enumerate(self._MIGRATIONS[version:], start=version + 1):
+                getattr(self, name)(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+
+    def init_db_once(self, lock_path: str):
+        """
+        持文件锁执行 init_db, 多个进程 (例如多个 worker 或多个启动器) 同时启动时迁移只执行一次, 其余等锁后发现已是最新版本
+        """
+        with open(lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.init_db()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def schema_version(self) -> int:
+        with self._connection() as conn:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migrate_v1_base_tables(self, conn: sqlite3.Connection):
         cursor = conn.cursor()
 
         cursor.execute("""
@@ -33,6 +291,7 @@ class DB:
         )
         """)
         
+        # fileref 列为旧版的 JSON 引用列表, 引用关系已迁移到 fileref 表, 该列保持为 '[]'
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS filehashdb (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -42,118 +301,377 @@ class DB:
         )
         """)
 
-        conn.commit()
-        conn.close()
+    def _migrate_v2_fileref(self, conn: sqlite3.Connection):
+        """
+        从旧版 filehashdb.fileref JSON 列表迁移到 fileref 表
+        owner/projectname/githash/path 字符串在名字含 '/' 时有歧义, 因此直接由 githashdb.filehashmap 重建
+        """
+        cursor = conn.cursor()
+
+        # 每个 release 中每个路径一行, 删除 release 时级联删除
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fileref (
+            filehash TEXT NOT NULL,
+            release_id INTEGER NOT NULL REFERENCES githashdb(id) ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            PRIMARY KEY (release_id, path)
+        ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS fileref_filehash_idx ON fileref (filehash, release_id)")
+
+        cursor.execute("""
+            INSERT OR IGNORE INTO fileref (filehash, release_id, path)
+            SELECT m.value, g.id, m.key FROM githashdb g, json_each(g.filehashmap) m
+        """)
+        cursor.execute("UPDATE filehashdb SET fileref = '[]' WHERE fileref != '[]'")
+
+    def _migrate_v3_githash_indexes(self, conn: sqlite3.Connection):
+        # 按项目列提交 / 取项目最新提交; 带上 githash, author 使列表查询只走索引
+        conn.execute("CREATE INDEX IF NOT EXISTS githashdb_project_time_idx ON githashdb (owner, projectname, time, githash, author)")
+        # find_exact_match / delete_release
+        conn.execute("CREATE INDEX IF NOT EXISTS githashdb_githash_idx ON githashdb (githash, projectname, owner)")
+
+    def _migrate_v4_projects_summary(self, conn: sqlite3.Connection):
+        """
+        每个 owner/projectname 一行的汇总表: 最新提交与提交数
+        由 githashdb 上的触发器增量维护, 项目列表接口只读这张表
+        """
+        cursor = conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            projectname TEXT NOT NULL,
+            githash TEXT NOT NULL,
+            author TEXT NOT NULL,
+            time TIMESTAMP,
+            commit_count INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (owner, projectname)
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS projects_time_idx ON projects (time, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS projects_owner_time_idx ON projects (owner, time, id)")
+
+        # 新提交: 提交数 +1, 时间不早于当前最新提交时替换为最新
+        cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS githashdb_projects_insert AFTER INSERT ON githashdb BEGIN
+            INSERT INTO projects (owner, projectname, githash, author, time, commit_count)
+            VALUES (NEW.owner, NEW.projectname, NEW.githash, NEW.author, NEW.time, 1)
+            ON CONFLICT (owner, projectname) DO UPDATE SET
+                commit_count = projects.commit_count + 1,
+                githash = CASE WHEN excluded.time >= projects.time THEN excluded.githash ELSE projects.githash END,
+                author = CASE WHEN excluded.time >= projects.time THEN excluded.author ELSE projects.author END,
+                time = CASE WHEN excluded.time >= projects.time THEN excluded.time ELSE projects.time END;
+        END
+        """)
+        # 删除提交: 提交数 -1, 删空则移除项目; 删掉的是最新提交时沿索引取下一条
+        cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS githashdb_projects_delete AFTER DELETE ON githashdb BEGIN
+            UPDATE projects SET commit_count = commit_count - 1
+            WHERE owner = OLD.owner AND projectname = OLD.projectname;
+            DELETE FROM projects
+            WHERE owner = OLD.owner AND projectname = OLD.projectname AND commit_count <= 0;
+            UPDATE projects SET (githash, author, time) = (
+                SELECT githash, author, time FROM githashdb
+                WHERE owner = OLD.owner AND projectname = OLD.projectname
+                ORDER BY time DESC, id DESC LIMIT 1
+            )
+            WHERE owner = OLD.owner AND projectname = OLD.projectname AND githash = OLD.githash;
+        END
+        """)
+
+        cursor.execute("""
+            INSERT OR REPLACE INTO projects (owner, projectname, githash, author, time, commit_count)
+            SELECT owner, projectname, githash, author, time, commit_count FROM (
+                SELECT owner, projectname, githash, author, time,
+                       COUNT(*) OVER (PARTITION BY owner, projectname) AS commit_count,
+                       ROW_NUMBER() OVER (PARTITION BY owner, projectname ORDER BY time DESC, id DESC) AS rn
+                FROM githashdb
+            ) WHERE rn = 1
+        """)
+
+    def _migrate_v5_keyset_index(self, conn: sqlite3.Connection):
+        # (time, id) 作为分页游标, id 需要紧跟在 time 之后才能让游标查询只沿索引走
+        conn.execute("DROP INDEX IF EXISTS githashdb_project_time_idx")
+        conn.execute("CREATE INDEX IF NOT EXISTS githashdb_project_time_id_idx ON githashdb (owner, projectname, time, id, githash, author)")
+
+    def _migrate_v6_release_parents(self, conn: sqlite3.Connection):
+        # 父提交的 githash 列表 (同一 owner/projectname 下): 增量提交时为基准 release, 合并时为多个
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(githashdb)")}
+        if 'parents' not in columns:
+            conn.execute("ALTER TABLE githashdb ADD COLUMN parents JSON DEFAULT '[]'")
+
+    def _migrate_v7_content_addressed_docs(self, conn: sqlite3.Connection):
+        """
+        filehashmap 与 projectfile 改为按内容寻址存储: 每个不同的文档 (projectfile 中的一个文件 / filehashmap 的一块) 在 jsondoc 中只存一份
+        release_doc 记录 release 引用了哪些文档, refcount 由触发器维护, 没有 release 引用时删除
+        fileref 改为按 filehashmap 块记录引用, 相同的块只有一份 path -> filehash 行
+        githashdb.filehashmap / projectfile 为旧版内联存储, 迁移后保持为 '{}', 释放的页由之后的写入复用 (VACUUM 可缩小文件)
+        """
+        cursor = conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jsondoc (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash TEXT UNIQUE NOT NULL,
+            body JSON NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        # kind 为 filehashmap 时 key 是块内第一个路径, 为 projectfile 时是文件名
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS release_doc (
+            release_id INTEGER NOT NULL REFERENCES githashdb(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            doc_id INTEGER NOT NULL REFERENCES jsondoc(id),
+            PRIMARY KEY (release_id, kind, key)
+        ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS release_doc_doc_idx ON release_doc (doc_id, release_id)")
+        cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS release_doc_insert AFTER INSERT ON release_doc BEGIN
+            UPDATE jsondoc SET refcount = refcount + 1 WHERE id = NEW.doc_id;
+        END
+        """)
+        # 删除 release 时级联删除 release_doc, 最后一个引用消失的文档连同其 fileref 一并删除
+        cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS release_doc_delete AFTER DELETE ON release_doc BEGIN
+            UPDATE jsondoc SET refcount = refcount - 1 WHERE id = OLD.doc_id;
+            DELETE FROM jsondoc WHERE id = OLD.doc_id AND refcount <= 0;
+        END
+        """)
+
+        cursor.execute("DROP TABLE IF EXISTS fileref")
+        cursor.execute("""
+        CREATE TABLE fileref (
+            filehash TEXT NOT NULL,
+            doc_id INTEGER NOT NULL REFERENCES jsondoc(id) ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            PRIMARY KEY (doc_id, path)
+        ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS fileref_filehash_idx ON fileref (filehash, doc_id)")
+
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, filehashmap, projectfile FROM githashdb WHERE id > ? ORDER BY id LIMIT 100",
+                (last_id,)
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                self._insert_release_docs(conn, row[0], json.loads(row[1] or '{}'), json.loads(row[2] or '{}'))
+            last_id = rows[-1][0]
+        conn.execute("UPDATE githashdb SET filehashmap = '{}', projectfile = '{}'")
+
+    def _migrate_v8_doc_kind_hash(self, conn: sqlite3.Connection):
+        """
+        v7 中 jsondoc 的 hash 只按内容计算, 与 projectfile 文件内容相同的 filehashmap 块会复用该文档而不写 fileref,
+        块中的对象被 GC 当作未引用; 这里把这类文档拆开, hash 改为带 kind, 并删除不属于 filehashmap 块的 fileref
+        """
+        shared = [row[0] for row in conn.execute("""
+            SELECT DISTINCT doc_id FROM release_doc WHERE kind = 'filehashmap'
+            AND doc_id IN (SELECT doc_id FROM release_doc WHERE kind = 'projectfile')
+        """)]
+        for doc_id in shared:
+            body = conn.execute("SELECT body FROM jsondoc WHERE id = ?", (doc_id,)).fetchone()[0]
+            refs = conn.execute(
+                "SELECT release_id, key FROM release_doc WHERE doc_id = ? AND kind = 'filehashmap'", (doc_id,)
+            ).fetchall()
+            # 仍被 projectfile 引用, 删除这些行不会删掉文档
+            conn.execute("DELETE FROM release_doc WHERE doc_id = ? AND kind = 'filehashmap'", (doc_id,))
+            new_id, created = self._store_doc(conn, 'filehashmap', body)
+            if created:
+                conn.execute(
+                    "INSERT INTO fileref (filehash, doc_id, path) SELECT value, ?, key FROM json_each(?)",
+                    (new_id, body)
+                )
+            conn.executemany(
+                "INSERT INTO release_doc (release_id, kind, key, doc_id) VALUES (?, 'filehashmap', ?, ?)",
+                [(release_id, key, new_id) for release_id, key in refs]
+            )
+        rows = conn.execute("""
+            SELECT d.id, d.body, (SELECT rd.kind FROM release_doc rd WHERE rd.doc_id = d.id LIMIT 1) FROM jsondoc d
+        """).fetchall()
+        for doc_id, body, kind in rows:
+            if kind is None:
+                conn.execute("DELETE FROM jsondoc WHERE id = ?", (doc_id,))
+            else:
+                conn.execute("UPDATE jsondoc SET hash = ? WHERE id = ?", (_doc_hash(kind, body), doc_id))
+        conn.execute("""
+            DELETE FROM fileref WHERE doc_id NOT IN (SELECT doc_id FROM release_doc WHERE kind = 'filehashmap')
+        """)
+
+    def explain_table_scans(self, statements: List[str]) -> List[Tuple[str, str]]:
+        """
+        对给定的 SQL 执行 EXPLAIN QUERY PLAN, 返回其中对真实表做全表扫描或需要临时 B-tree 排序 / 去重的 (sql, detail)
+        按别名报告的扫描也算; SCAN ... USING INDEX, 虚表 (json_each) 与物化子查询结果的扫描不算
+        """
+        scans = []
+        with self._connection() as conn:
+            for sql in statements:
+                if not _EXPLAINABLE.match(sql):
+                    continue
+                subqueries = set()
+                for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+                    detail = row['detail']
+                    m = _SUBQUERY.match(detail)
+                    if m:
+                        subqueries.add(m.group(1))
+                    m = _TABLE_SCAN.match(detail)
+                    if m and m.group(1) not in subqueries or detail.startswith('USE TEMP B-TREE'):
+                        scans.append((sql, detail))
+        return scans
     
+    def _chunks(self, conn: sqlite3.Connection, items: List[Any]):
+        """
+        按单条语句的参数个数上限 (旧版 SQLite 为 999, 3.32 起为 32766) 切分 IN 列表
+        """
+        getlimit = getattr(conn, 'getlimit', None)
+        size = getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if getlimit else 999
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
     def query_filehash(self, input_list):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # 创建参数占位符（?,?,?...）
-        placeholders = ','.join(['?' for _ in input_list])
-        
-        # 执行查询：查找表中存在的所有匹配项
-        query = f"SELECT * FROM filehashdb WHERE filehash IN ({placeholders})"
-        cursor.execute(query, input_list)
-        
-        # 获取查询结果
-        results = {row[1]:json.loads(row[2]) for row in cursor.fetchall()}
+        results = {}
+        with self._connection() as conn:
+            for chunk in self._chunks(conn, sorted(set(input_list))):
+                # 创建参数占位符（?,?,?...）
+                placeholders = ','.join(['?' for _ in chunk])
 
-        conn.close()
+                # 执行查询：查找表中存在的所有匹配项, 以及引用它们的 owner/projectname/githash/path
+                query = f"""
+                SELECT f.filehash, g.id, g.owner, g.projectname, g.githash, r.path
+                FROM filehashdb f
+                LEFT JOIN fileref r ON r.filehash = f.filehash
+                LEFT JOIN release_doc d ON d.doc_id = r.doc_id AND d.kind = 'filehashmap'
+                LEFT JOIN githashdb g ON g.id = d.release_id
+                WHERE f.filehash IN ({placeholders})
+                ORDER BY f.filehash
+                """
+                for row in conn.execute(query, chunk):
+                    refs = results.setdefault(row[0], [])
+                    if row[1] is not None:
+                        refs.append((row[1], row[5], f'{row[2]}/{row[3]}/{row[4]}/{row[5]}'))
 
-        return results
+        # 每个 hash 的引用按 (release id, path) 排序, 在这里排而不是让 SQLite 为每个 hash 建临时 B-tree
+        return {filehash: [ref for _, _, ref in sorted(refs)] for filehash, refs in results.items()}
 
     def find_matching_filehash(self, input_list)->List[str]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # 创建参数占位符（?,?,?...）
-        placeholders = ','.join(['?' for _ in input_list])
-        
-        # 执行查询：查找表中存在的所有匹配项
-        query = f"SELECT filehash FROM filehashdb WHERE filehash IN ({placeholders})"
-        cursor.execute(query, input_list)
-        
-        # 获取查询结果
-        results = [row[0] for row in cursor.fetchall()]
+        """
+        返回 input_list 中已存在于 filehashdb 的 hash, 去重, 输入任意多个
+        输入排序后分批 IN 查询, 相邻的查找落在索引的相邻页上;
+        输入达到表行数一半以上时, 顺序扫一遍索引再与输入求交比逐个查找快
+        """
+        with self._connection() as conn:
+            return self._find_matching_filehash(conn, input_list)
 
-        conn.close()
+    def _find_matching_filehash(self, conn: sqlite3.Connection, input_list) -> List[str]:
+        wanted = sorted(set(input_list))
+        if not wanted:
+            return []
+        rows = conn.execute("SELECT max(id) FROM filehashdb").fetchone()[0] or 0
+        if len(wanted) * 2 > rows:
+            wanted_set = set(wanted)
+            cursor = conn.execute("SELECT filehash FROM filehashdb INDEXED BY sqlite_autoindex_filehashdb_1")
+            return [row[0] for row in cursor if row[0] in wanted_set]
+        results = []
+        for chunk in self._chunks(conn, wanted):
+            placeholders = ','.join(['?' for _ in chunk])
+            cursor = conn.execute(f"SELECT filehash FROM filehashdb WHERE filehash IN ({placeholders})", chunk)
+            results.extend(row[0] for row in cursor)
         return results
 
-    def add_filehash(self, input_list):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+    def list_filehash_since(self, after_id: int, limit: int) -> List[Tuple[int, str]]:
+        """
+        id 大于 after_id 的 filehashdb 条目 (id, filehash), 按 id 顺序; 供内存中的 hash 过滤器增量同步
+        """
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "SELECT id, filehash FROM filehashdb WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)
+            )
+            return [(row[0], row[1]) for row in cursor.fetchall()]
 
+    def add_filehash(self, input_list):
         data = [(hash_val,) for hash_val in input_list]
-    
-        try:
-            cursor.executemany(
+
+        with self._transaction() as conn:
+            conn.executemany(
                 "INSERT OR IGNORE INTO filehashdb (filehash) VALUES (?)",
                 data
             )
-            conn.commit()
-        except sqlite3.Error as e:
-            raise e
-        finally:
-            conn.close()
-    
-    def set_filehash(self, filehashmap: Dict[str, List[str]]):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
 
-        data = [(hash_val, json.dumps(fileref, ensure_ascii=False)) for hash_val, fileref in filehashmap.items()]
-    
-        try:
-            cursor.executemany(
-                "INSERT OR REPLACE INTO filehashdb (filehash, fileref) VALUES (?, ?)",
-                data
-            )
-            conn.commit()
-        except sqlite3.Error as e:
-            raise e
-        finally:
-            conn.close()
+    def list_filehash_after(self, after_id: int, limit: int, before: str) -> List[Dict[str, Any]]:
+        """
+        按 id 顺序分批列出 time 早于 before 的 filehashdb 条目, 附带是否仍被某个 release 引用
+        供 GC 遍历全表, 每批只持有一次读连接
+        """
+        with self._connection() as conn:
+            cursor = conn.execute("""
+                SELECT f.id, f.filehash, EXISTS (SELECT 1 FROM fileref r WHERE r.filehash = f.filehash) AS referenced
+                FROM filehashdb f
+                WHERE f.id > ? AND f.time < ?
+                ORDER BY f.id LIMIT ?
+            """, (after_id, before, limit))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def delete_unreferenced_filehash(self, input_list: List[str]) -> List[str]:
+        """
+        删除 input_list 中没有被任何 release 引用的 filehashdb 条目, 返回实际删除的 hash
+        与 submit_release 同为 BEGIN IMMEDIATE 事务, 被新提交引用的 hash 不会被删除
+        """
+        deleted = []
+        with self._transaction() as conn:
+            for hash_val in input_list:
+                cursor = conn.execute("""
+                    DELETE FROM filehashdb WHERE filehash = ?
+                    AND NOT EXISTS (SELECT 1 FROM fileref r WHERE r.filehash = filehashdb.filehash)
+                """, (hash_val,))
+                if cursor.rowcount:
+                    deleted.append(hash_val)
+        return deleted
 
+    def delete_filehash(self, input_list: List[str]) -> int:
+        """
+        删除 filehashdb 条目 (对象文件已丢失时), 之后 /checkFile 会让客户端重新上传
+        """
+        with self._transaction() as conn:
+            cursor = conn.executemany("DELETE FROM filehashdb WHERE filehash = ?", [(h,) for h in input_list])
+            return cursor.rowcount
 
     def find_exact_match(
         self,
         githash: str,
         projectname: str,
-        owner: str
+        owner: str,
+        fields: Optional[List[str]] = None
     ) -> List[Dict[str, Any]]:
         """
         查询 githash, projectname, owner 三个字段都完全匹配的条目
-        返回匹配的条目数组
+        返回匹配的条目数组; fields 指定只返回部分字段, 不含大字段时不读取也不解码它们
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        query = """
-        SELECT * FROM githashdb 
+        columns = _release_columns(fields, RELEASE_FIELDS)
+        query = f"""
+        SELECT {_release_select(columns)} FROM githashdb 
         WHERE githash = ? 
         AND projectname = ? 
         AND owner = ?
         ORDER BY id
         """
-        
-        cursor.execute(query, (githash, projectname, owner))
-        
-        # 获取结果并转换为字典列表
-        columns = [desc[0] for desc in cursor.description]
-        results = []
-        
-        for row in cursor.fetchall():
-            row_dict = dict(zip(columns, row))
-            _decode_json_field(row_dict, 'filehashmap')
-            _decode_json_field(row_dict, 'projectfile')
-            results.append(row_dict)
 
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (githash, projectname, owner))
+            
+            # 获取结果并转换为字典列表
+            columns = [desc[0] for desc in cursor.description]
+            results = []
+            
+            for row in cursor.fetchall():
+                row_dict = dict(zip(columns, row))
+                results.append(_decode_release(row_dict))
         
         return results
 
@@ -180,28 +698,46 @@ class DB:
             time: 时间戳字符串 (格式: 'YYYY-MM-DD HH:MM:SS')
 
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # 将字典转换为JSON字符串
-        filehashmap_json = json.dumps(filehashmap, ensure_ascii=False)
-        projectfile_json = json.dumps(projectfile, ensure_ascii=False)
-        
-        try:
-            cursor.execute("""
-                INSERT INTO githashdb
-                (githash, projectname, owner, author, filehashmap, projectfile, time)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (githash, projectname, owner, author, 
-                filehashmap_json, projectfile_json, time))
-            
-            conn.commit()
-        except sqlite3.Error as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        with self._transaction() as conn:
+            self._insert_release(conn, githash, projectname, owner, author, filehashmap, projectfile, time)
+
+    def _insert_release(self, conn: sqlite3.Connection, githash, projectname, owner, author, filehashmap, projectfile, time, parents=None) -> int:
+        cursor = conn.execute("""
+            INSERT INTO githashdb
+            (githash, projectname, owner, author, time, parents)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (githash, projectname, owner, author, time, json.dumps(parents or [], ensure_ascii=False)))
+        release_id = cursor.lastrowid
+        self._insert_release_docs(conn, release_id, filehashmap, projectfile)
+        return release_id
+
+    def _store_doc(self, conn: sqlite3.Connection, kind: str, body: str) -> Tuple[int, bool]:
+        """
+        按 (kind, 内容) 的 hash 存入 jsondoc, 返回 (id, 是否新建)
+        kind 参与 hash: filehashmap 块与内容相同的 projectfile 文件不能共用一行, 否则块的 fileref 不会写入
+        """
+        doc_hash = _doc_hash(kind, body)
+        cursor = conn.execute("INSERT INTO jsondoc (hash, body) VALUES (?, ?) ON CONFLICT (hash) DO NOTHING", (doc_hash, body))
+        if cursor.rowcount:
+            return cursor.lastrowid, True
+        return conn.execute("SELECT id FROM jsondoc WHERE hash = ?", (doc_hash,)).fetchone()[0], False
+
+    def _insert_release_docs(self, conn: sqlite3.Connection, release_id: int, filehashmap: dict, projectfile: dict):
+        if not isinstance(filehashmap, dict) or not isinstance(projectfile, dict):
+            raise ValueError('filehashmap and projectfile must be objects')
+        refs = []
+        for key, body in _chunk_filehashmap(filehashmap):
+            doc_id, created = self._store_doc(conn, 'filehashmap', body)
+            if created:
+                # 新的块: 每个 path -> filehash 写入一行引用
+                conn.execute(
+                    "INSERT INTO fileref (filehash, doc_id, path) SELECT value, ?, key FROM json_each(?)",
+                    (doc_id, body)
+                )
+            refs.append((release_id, 'filehashmap', key, doc_id))
+        for name, value in projectfile.items():
+            refs.append((release_id, 'projectfile', name, self._store_doc(conn, 'projectfile', _dumps_doc(value))[0]))
+        conn.executemany("INSERT INTO release_doc (release_id, kind, key, doc_id) VALUES (?, ?, ?, ?)", refs)
 
 
     def delete_by_ids(self, id_list: List[int]) -> int:
@@ -214,31 +750,18 @@ class DB:
         Returns:
             删除的行数
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
         if not id_list:
             return 0  # 空列表不执行任何操作
         
-        cursor = conn.cursor()
-        
         # 创建参数占位符
         placeholders = ','.join(['?' for _ in id_list])
         
         # 构建删除语句
         query = f"DELETE FROM githashdb WHERE id IN ({placeholders})"
-        
-        try:
-            cursor.execute(query, id_list)
-            deleted_count = cursor.rowcount
-            conn.commit()
-            return deleted_count
-        except sqlite3.Error as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+
+        with self._transaction() as conn:
+            cursor = conn.execute(query, id_list)
+            return cursor.rowcount
     
     def delete_release(self,
         githash: str,
@@ -246,53 +769,26 @@ class DB:
         owner: str) -> int:
         """
         查询 githash, projectname, owner 三个字段都完全匹配的条目
-        删除条目以及在filehash中删除对应的记录
+        删除条目以及在filehash中删除对应的记录, 整体在一个事务内完成
         """
+        with self._transaction() as conn:
+            return self._delete_release(conn, githash, projectname, owner)
 
-        # 查询匹配的条目
-        rows = self.find_exact_match(
-            githash=githash,
-            projectname=projectname,
-            owner=owner
+    def _delete_release(self, conn: sqlite3.Connection, githash: str, projectname: str, owner: str) -> int:
+        # fileref 中的引用由外键 ON DELETE CASCADE 一并删除
+        cursor = conn.execute(
+            "DELETE FROM githashdb WHERE githash = ? AND projectname = ? AND owner = ?",
+            (githash, projectname, owner)
         )
+        return cursor.rowcount
 
-        if not rows:
-            return 0
-
-        try:
-           
-            # 删除对应的 filehash 记录
-            filehashes_to_delete = []
-            for row in rows:
-                filehashmap = row['filehashmap']
-                filehashes_to_delete.extend(filehashmap.items())
-
-            if filehashes_to_delete:
-                records = self.query_filehash([item[1] for item in filehashes_to_delete])
-                for item in filehashes_to_delete:
-                    filehash = item[1]
-                    if filehash in records:
-                        fileref = f'{owner}/{projectname}/{githash}/{item[0]}'
-                        if fileref in records[filehash]:
-                            records[filehash].remove(fileref)
-                self.set_filehash(records)
-
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            # 删除 githash 记录
-            ids_to_delete = [row['id'] for row in rows]
-            placeholders = ','.join(['?' for _ in ids_to_delete])
-            cursor.execute(f"DELETE FROM githashdb WHERE id IN ({placeholders})", ids_to_delete)
-
-            deleted_count = cursor.rowcount
-            conn.commit()
-            return deleted_count
-        except sqlite3.Error as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+    def _missing_filehash(self, conn: sqlite3.Connection, filehashmap_json: str) -> List[str]:
+        cursor = conn.execute("""
+            SELECT m.value FROM json_each(?) m
+            WHERE NOT EXISTS (SELECT 1 FROM filehashdb f WHERE f.filehash = m.value)
+        """, (filehashmap_json,))
+        # 同一 hash 可对应多个路径, 按首次出现去重
+        return list(dict.fromkeys(row[0] for row in cursor.fetchall()))
     
     def submit_release(
         self,
@@ -302,43 +798,318 @@ class DB:
         author: str,
         filehashmap: dict,
         projectfile: dict,
-        time: str
+        time: str,
+        parents: Optional[List[str]] = None
     )->(int, List[str]):
         """
         提交发布，先检查filehashmap中的hash是否都存在于filehash表中，如果有不存在的hash，则返回错误和缺失的hash列表；如果都存在，则删除原有的release（如果有的话），并插入新的release
+        检查、引用更新、旧 release 删除与插入在同一个 BEGIN IMMEDIATE 事务内, 只提交一次
         """
-        hashes=list(filehashmap.values())
-        had=self.find_matching_filehash(hashes)
-        missing_hashes = set(hashes) - set(had)
-        if missing_hashes:
-            return 0, list(missing_hashes)
-        count=self.delete_release(githash, projectname, owner)
-
-        records = self.query_filehash(list(filehashmap.values()))
-        for fileref,filehash in filehashmap.items():
-            fileref=f'{owner}/{projectname}/{githash}/{fileref}'
-            if fileref not in records[filehash]:
-                records[filehash].append(fileref)
-        self.set_filehash(records)
-
-        self.insert_githash_full(
-            githash=githash,
-            projectname=projectname,
-            owner=owner,
-            author=author,
-            filehashmap=filehashmap,
-            projectfile=projectfile,
-            time=time
-        )
+        filehashmap_json = json.dumps(filehashmap, ensure_ascii=False)
+        with self._transaction() as conn:
+            missing_hashes = self._missing_filehash(conn, filehashmap_json)
+            if missing_hashes:
+                return 0, missing_hashes
+            count = self._delete_release(conn, githash, projectname, owner)
+            self._insert_release(conn, githash, projectname, owner, author, filehashmap, projectfile, time, parents)
         return count, []
 
+    def submit_release_delta(
+        self,
+        githash: str,
+        projectname: str,
+        owner: str,
+        author: str,
+        parent: str,
+        filehashmap_patch: dict,
+        projectfile_patch: dict,
+        time: str,
+        parents: Optional[List[str]] = None
+    )->(int, List[str]):
+        """
+        以同一项目下 githash 为 parent 的 release 为基准增量提交
+        filehashmap_patch / projectfile_patch 为 JSON merge patch (RFC 7396): 值为 null 表示删除该路径 / 字段, 其余为新增或修改
+        合并由 SQLite 的 json_patch 完成; 只检查 patch 中新出现的 hash 是否存在
+        未改动的 filehashmap 块与 projectfile 文件与 parent 共用同一份存储
+        parents 默认为 [parent]
+        """
+        filehashmap_patch_json = json.dumps(filehashmap_patch, ensure_ascii=False)
+        projectfile_patch_json = json.dumps(projectfile_patch, ensure_ascii=False)
+        with self._transaction() as conn:
+            row = conn.execute(f"""
+                SELECT json_patch({_RELEASE_EXPRS['filehashmap']}, ?), json_patch({_RELEASE_EXPRS['projectfile']}, ?)
+                FROM githashdb
+                WHERE githash = ? AND projectname = ? AND owner = ?
+                ORDER BY id DESC LIMIT 1
+            """, (filehashmap_patch_json, projectfile_patch_json, parent, projectname, owner)).fetchone()
+            if row is None:
+                raise ValueError(f'parent release not found: {owner}/{projectname}/{parent}')
+            added = {path: filehash for path, filehash in filehashmap_patch.items() if filehash is not None}
+            missing_hashes = self._missing_filehash(conn, json.dumps(added, ensure_ascii=False))
+            if missing_hashes:
+                return 0, missing_hashes
+            count = self._delete_release(conn, githash, projectname, owner)
+            self._insert_release(conn, githash, projectname, owner, author, json.loads(row[0]), json.loads(row[1]), time, parents or [parent])
+        return count, []
+
+    def _release_id(self, conn: sqlite3.Connection, githash: str, projectname: str, owner: str) -> int:
+        row = conn.execute(
+            "SELECT id FROM githashdb WHERE githash = ? AND projectname = ? AND owner = ? ORDER BY id DESC LIMIT 1",
+            (githash, projectname, owner)
+        ).fetchone()
+        if row is None:
+            raise ValueError(f'release not found: {owner}/{projectname}/{githash}')
+        return row[0]
+
+    def _merge(self, conn: sqlite3.Connection, sources: List[Tuple[str, str, str]]) -> Dict[str, Any]:
+        releases = []
+        for owner, projectname, githash in sources:
+            release_id = self._release_id(conn, githash, projectname, owner)
+            row = conn.execute(
+                f"SELECT {_release_select(['filehashmap', 'projectfile'])} FROM githashdb WHERE id = ?", (release_id,)
+            ).fetchone()
+            releases.append(_decode_release(dict(row)))
+        # 有效快照: hash 仍在 filehashdb 中 (对象未丢失)
+        valid = set(self._find_matching_filehash(conn, [h for release in releases for h in release['filehashmap'].values()]))
+        filehashmap = {}
+        projectfile = {}
+        conflicts = set()
+        # 按优先级从低到高覆盖
+        for release in releases:
+            for path, filehash in release['filehashmap'].items():
+                if filehash not in valid:
+                    continue
+                previous = filehashmap.get(path)
+                if previous is not None and previous != filehash:
+                    conflicts.add(path)
+                filehashmap[path] = filehash
+            projectfile.update(release['projectfile'])
+        return {'filehashmap': filehashmap, 'projectfile': projectfile, 'conflicts': sorted(conflicts)}
+
+    def merge_releases(self, sources: List[Tuple[str, str, str]]) -> Dict[str, Any]:
+        """
+        合并拉取: sources 为 [(owner, projectname, githash)], 靠后的优先
+        filehashmap 逐路径取优先级最高的有效快照 (hash 仍在 filehashdb 中), 只有靠前的 release 有的路径保留; projectfile 逐文件取优先级最高的
+        只读取元数据, 不涉及对象文件; 返回 {filehashmap, projectfile, conflicts}, conflicts 为有效快照 hash 不一致的路径
+        """
+        with self._connection() as conn:
+            return self._merge(conn, sources)
+
+    def submit_merge(
+        self,
+        sources: List[Tuple[str, str, str]],
+        githash: str,
+        projectname: str,
+        owner: str,
+        author: str,
+        time: str
+    ) -> Dict[str, Any]:
+        """
+        merge_releases 并把结果作为新 release 提交 (覆盖同名 release), parents 为各来源的 githash
+        合并与写入在同一个 BEGIN IMMEDIATE 事务内; 合并结果只含已存在的 hash, 不需要再检查文件缺失
+        返回值另带 count: 覆盖的条目数
+        """
+        with self._transaction() as conn:
+            merged = self._merge(conn, sources)
+            merged['count'] = self._delete_release(conn, githash, projectname, owner)
+            self._insert_release(conn, githash, projectname, owner, author, merged['filehashmap'], merged['projectfile'], time,
+                                 [source[2] for source in sources])
+        return merged
+
+    def _load_docs(self, conn: sqlite3.Connection, doc_ids) -> Dict[int, Any]:
+        docs = {}
+        for chunk in self._chunks(conn, sorted(doc_ids)):
+            placeholders = ','.join(['?' for _ in chunk])
+            for doc_id, body in conn.execute(f"SELECT id, body FROM jsondoc WHERE id IN ({placeholders})", chunk):
+                docs[doc_id] = json.loads(body)
+        return docs
+
+    def diff_releases(self, from_id: int, to_id: int) -> Dict[str, Any]:
+        """
+        两个 release (githashdb.id) 的差异
+        filehashmap 按块比较: 两边都引用的块内容相同, 直接跳过, 只解码不同的块; 路径的切块只由路径决定, 同一路径在两边不同的块中
+        projectfile 引用不同文档的文件再逐键比较
+        返回 {added: {path: hash}, removed: {path: hash}, changed: {path: [旧 hash, 新 hash]},
+              projectfile: {added: [文件名], removed: [文件名], changed: {文件名: {added, removed, changed}}}}
+        """
+        with self._connection() as conn:
+            refs = {from_id: {'filehashmap': {}, 'projectfile': {}}, to_id: {'filehashmap': {}, 'projectfile': {}}}
+            for release_id, kind, key, doc_id in conn.execute(
+                "SELECT release_id, kind, key, doc_id FROM release_doc WHERE release_id IN (?, ?)", (from_id, to_id)
+            ):
+                refs[release_id][kind][key] = doc_id
+            old_chunks = set(refs[from_id]['filehashmap'].values())
+            new_chunks = set(refs[to_id]['filehashmap'].values())
+            old_files = refs[from_id]['projectfile']
+            new_files = refs[to_id]['projectfile']
+            changed_files = [name for name in old_files.keys() & new_files.keys() if old_files[name] != new_files[name]]
+            docs = self._load_docs(conn, (old_chunks ^ new_chunks)
+                                   | {old_files[name] for name in changed_files} | {new_files[name] for name in changed_files})
+
+        old = {}
+        for doc_id in old_chunks - new_chunks:
+            old.update(docs[doc_id])
+        new = {}
+        for doc_id in new_chunks - old_chunks:
+            new.update(docs[doc_id])
+        return {
+            'added': {path: new[path] for path in sorted(new.keys() - old.keys())},
+            'removed': {path: old[path] for path in sorted(old.keys() - new.keys())},
+            'changed': {path: [old[path], new[path]] for path in sorted(old.keys() & new.keys()) if old[path] != new[path]},
+            'projectfile': {
+                'added': sorted(new_files.keys() - old_files.keys()),
+                'removed': sorted(old_files.keys() - new_files.keys()),
+                'changed': {name: _json_key_diff(docs[old_files[name]], docs[new_files[name]]) for name in sorted(changed_files)},
+            },
+        }
+
+    def list_filehash_releases(self, filehash: str, after: Optional[Tuple[int, str]], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Tuple[int, str]]]:
+        """
+        引用 filehash 的 release 与路径, 新提交在前; 游标为 (release id, path)
+        fileref 按 filehash 索引找到包含它的块, 引用每块的 release 由 release_doc_doc_idx 按 id 倒序给出,
+        在这里按块归并而不是让 SQLite 把所有引用读出后建临时 B-tree 排序:
+        每页为一条语句内包含该 hash 的块数次索引查找, 加上本页用到的 (块, release) 数次单行查询, 与引用总数无关
+        """
+        next_release = """
+            SELECT release_id FROM release_doc WHERE doc_id = {} AND kind = 'filehashmap' AND release_id {} ?
+            ORDER BY release_id DESC LIMIT 1
+        """
+        refs = []
+        with self._connection() as conn:
+            docs: Dict[int, List[str]] = {}
+            for doc_id, path in conn.execute("SELECT doc_id, path FROM fileref WHERE filehash = ? ORDER BY doc_id, path", (filehash,)):
+                docs.setdefault(doc_id, []).append(path)
+            # 每块不晚于游标的最新一个 release
+            heads = conn.execute(
+                f"SELECT m.value, ({next_release.format('m.value', '<=')}) FROM json_each(?) m",
+                (after[0] if after is not None else 2 ** 63 - 1, json.dumps(list(docs)))
+            ).fetchall()
+            heap = [(-release_id, doc_id) for doc_id, release_id in heads if release_id is not None]
+            heapq.heapify(heap)
+            while heap and len(refs) <= limit:
+                neg_id, doc_id = heapq.heappop(heap)
+                # 同一 release 中包含该 hash 的各块一起取出, 路径合并排序
+                popped = [doc_id]
+                while heap and heap[0][0] == neg_id:
+                    popped.append(heapq.heappop(heap)[1])
+                release_id = -neg_id
+                paths = sorted(itertools.chain.from_iterable(docs[d] for d in popped))
+                if after is not None and release_id == after[0]:
+                    paths = [path for path in paths if path > after[1]]
+                refs.extend((release_id, path) for path in paths)
+                for d in popped:
+                    row = conn.execute(next_release.format('?', '<'), (d, release_id)).fetchone()
+                    if row is not None:
+                        heapq.heappush(heap, (-row[0], d))
+            releases = {}
+            for chunk in self._chunks(conn, sorted({release_id for release_id, _ in refs[:limit]})):
+                placeholders = ','.join(['?' for _ in chunk])
+                for row in conn.execute(f"SELECT id, owner, projectname, githash, author, time FROM githashdb WHERE id IN ({placeholders})", chunk):
+                    releases[row['id']] = dict(row)
+        page = []
+        for release_id, path in refs[:limit]:
+            release = releases.get(release_id)
+            # 两次读取之间被删除
+            if release is not None:
+                page.append(dict(path=path, **{k: v for k, v in release.items() if k != 'id'}))
+        next_key = refs[limit - 1] if len(refs) > limit else None
+        return page, next_key
+
+    def _path_history_batch(self, conn: sqlite3.Connection, owner: str, projectname: str, path: str, after: Optional[Tuple[str, int]], limit: int) -> List[Dict[str, Any]]:
+        # 路径所在的块为 key (块内第一个路径) 不大于 path 的最后一块, 每个提交两次索引查找
+        query = """
+            SELECT g.id, g.githash, g.author, g.time, (
+                SELECT r.filehash FROM fileref r
+                WHERE r.path = :path AND r.doc_id = (
+                    SELECT d.doc_id FROM release_doc d
+                    WHERE d.release_id = g.id AND d.kind = 'filehashmap' AND d.key <= :path
+                    ORDER BY d.key DESC LIMIT 1
+                )
+            ) AS filehash
+            FROM githashdb g
+            WHERE g.owner = :owner AND g.projectname = :projectname{}
+            ORDER BY g.time DESC, g.id DESC
+            LIMIT :limit
+        """
+        params = {'path': path, 'owner': owner, 'projectname': projectname, 'limit': limit}
+        if after is None:
+            cursor = conn.execute(query.format(''), params)
+        else:
+            params.update(time=after[0], id=after[1])
+            cursor = conn.execute(query.format(' AND (g.time, g.id) < (:time, :id)'), params)
+        return [dict(row) for row in cursor.fetchall()]
+
+    def list_path_history(
+        self,
+        owner: str,
+        projectname: str,
+        path: str,
+        after: Optional[Tuple[str, int]],
+        limit: int,
+        changes_only: bool = False,
+        max_scan: int = PATH_HISTORY_MAX_SCAN
+    ) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+        """
+        owner/projectname 的各个提交中 path 对应的 filehash, 新提交在前, 不含该路径的提交 filehash 为 None; 游标与 list_commits_after 相同
+        changes_only 时只返回与前一个 (更早的) 提交不同的提交, 即该路径内容出现 / 改变 / 删除的提交;
+        很少改变的路径要扫描很多提交才凑满一页, 扫描超过 max_scan 个提交即停止, 返回不足 limit 条 (可能为空) 的结果与下一页游标
+        """
+        batch = limit + 1 if not changes_only else max(limit * 4, 256)
+        results = []
+        # changes_only: 上一行要与更早的一行比较后才知道是否为改变; resume 为 pending 之前 (更新) 一行的游标
+        pending = None
+        resume = after
+        key = after
+        scanned = 0
+        truncated = False
+        with self._connection() as conn:
+            while len(results) <= limit:
+                rows = self._path_history_batch(conn, owner, projectname, path, key, batch)
+                scanned += len(rows)
+                for row in rows:
+                    if not changes_only:
+                        results.append(row)
+                    else:
+                        if pending is not None:
+                            if pending['filehash'] != row['filehash']:
+                                results.append(pending)
+                            resume = (pending['time'], pending['id'])
+                        pending = row
+                if len(rows) < batch:
+                    # 最早的提交: 含该路径即为出现
+                    if changes_only and pending is not None and pending['filehash'] is not None:
+                        results.append(pending)
+                    break
+                key = (rows[-1]['time'], rows[-1]['id'])
+                if changes_only and scanned >= max_scan and resume is not None:
+                    truncated = len(results) <= limit
+                    break
+        if truncated:
+            # 下一页从尚未判断的 pending 开始
+            page, next_key = results, resume
+        else:
+            page = results[:limit]
+            next_key = (page[-1]['time'], page[-1]['id']) if len(results) > limit else None
+        for row in page:
+            row.pop('id')
+        return page, next_key
+
+    def _keyset_page(self, rows: List[sqlite3.Row], limit: int, keep_id: bool = False) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+        """
+        rows 按 (time, id) 倒序并多取了一条; 返回本页的行与下一页的 (time, id), 没有下一页时为 None
+        """
+        page = [dict(row) for row in rows[:limit]]
+        next_key = (page[-1]['time'], page[-1]['id']) if len(rows) > limit else None
+        if not keep_id:
+            for row in page:
+                row.pop('id')
+        return page, next_key
+
     def list_owners(self) -> List[str]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT owner FROM githashdb ORDER BY owner")
-        owners = [row[0] for row in cursor.fetchall()]
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT owner FROM projects ORDER BY owner")
+            owners = [row[0] for row in cursor.fetchall()]
         return owners
 
     def _rows_to_releases(self, rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
@@ -346,105 +1117,172 @@ class DB:
         releases = []
         for row in rows:
             row_dict = {col: row[col] for col in columns}
-            _decode_json_field(row_dict, 'filehashmap')
-            _decode_json_field(row_dict, 'projectfile')
-            releases.append(row_dict)
+            releases.append(_decode_release(row_dict))
         return releases
 
     def count_projects_global(self) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM (SELECT owner, projectname FROM githashdb GROUP BY owner, projectname)")
-        total = cursor.fetchone()[0]
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM projects")
+            total = cursor.fetchone()[0]
         return total
 
     def list_projects_global(self, offset: int, limit: int) -> List[Dict[str, Any]]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT owner, projectname, githash, author, time FROM (
-                SELECT owner, projectname, githash, author, time,
-                       ROW_NUMBER() OVER (PARTITION BY owner, projectname ORDER BY time DESC) AS rn
-                FROM githashdb
-            ) WHERE rn = 1
-            ORDER BY time DESC
-            LIMIT ? OFFSET ?
-            """,
-            (limit, offset)
-        )
-        rows = cursor.fetchall()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT owner, projectname, githash, author, time, commit_count FROM projects
+                ORDER BY time DESC, id DESC
+                LIMIT ? OFFSET ?
+                """,
+                (limit, offset)
+            )
+            rows = cursor.fetchall()
         return [dict(row) for row in rows]
 
+    def list_projects_global_after(self, after: Optional[Tuple[str, int]], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+        """
+        游标分页: 返回排在 after=(time, id) 之后的 limit 个项目, 以及下一页的游标
+        """
+        with self._connection() as conn:
+            if after is None:
+                cursor = conn.execute(
+                    """
+                    SELECT id, owner, projectname, githash, author, time, commit_count FROM projects
+                    ORDER BY time DESC, id DESC LIMIT ?
+                    """,
+                    (limit + 1,)
+                )
+            else:
+                cursor = conn.execute(
+                    """
+                    SELECT id, owner, projectname, githash, author, time, commit_count FROM projects
+                    WHERE (time, id) < (?, ?)
+                    ORDER BY time DESC, id DESC LIMIT ?
+                    """,
+                    (after[0], after[1], limit + 1)
+                )
+            rows = cursor.fetchall()
+        return self._keyset_page(rows, limit)
+
     def count_projects_by_owner(self, owner: str) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT COUNT(*) FROM (SELECT projectname FROM githashdb WHERE owner = ? GROUP BY projectname)",
-            (owner,)
-        )
-        total = cursor.fetchone()[0]
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM projects WHERE owner = ?", (owner,))
+            total = cursor.fetchone()[0]
         return total
 
     def list_projects_by_owner(self, owner: str, offset: int, limit: int) -> List[Dict[str, Any]]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT owner, projectname, githash, author, time FROM (
-                SELECT owner, projectname, githash, author, time,
-                       ROW_NUMBER() OVER (PARTITION BY owner, projectname ORDER BY time DESC) AS rn
-                FROM githashdb WHERE owner = ?
-            ) WHERE rn = 1
-            ORDER BY time DESC
-            LIMIT ? OFFSET ?
-            """,
-            (owner, limit, offset)
-        )
-        rows = cursor.fetchall()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT owner, projectname, githash, author, time, commit_count FROM projects
+                WHERE owner = ?
+                ORDER BY time DESC, id DESC
+                LIMIT ? OFFSET ?
+                """,
+                (owner, limit, offset)
+            )
+            rows = cursor.fetchall()
         return [dict(row) for row in rows]
 
+    def list_projects_by_owner_after(self, owner: str, after: Optional[Tuple[str, int]], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+        with self._connection() as conn:
+            if after is None:
+                cursor = conn.execute(
+                    """
+                    SELECT id, owner, projectname, githash, author, time, commit_count FROM projects
+                    WHERE owner = ?
+                    ORDER BY time DESC, id DESC LIMIT ?
+                    """,
+                    (owner, limit + 1)
+                )
+            else:
+                cursor = conn.execute(
+                    """
+                    SELECT id, owner, projectname, githash, author, time, commit_count FROM projects
+                    WHERE owner = ? AND (time, id) < (?, ?)
+                    ORDER BY time DESC, id DESC LIMIT ?
+                    """,
+                    (owner, after[0], after[1], limit + 1)
+                )
+            rows = cursor.fetchall()
+        return self._keyset_page(rows, limit)
+
     def count_commits(self, owner: str, projectname: str) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT COUNT(*) FROM githashdb WHERE owner = ? AND projectname = ?",
-            (owner, projectname)
-        )
-        total = cursor.fetchone()[0]
-        conn.close()
-        return total
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT commit_count FROM projects WHERE owner = ? AND projectname = ?",
+                (owner, projectname)
+            )
+            row = cursor.fetchone()
+        return row[0] if row else 0
 
-    def list_commits(self, owner: str, projectname: str, offset: int, limit: int) -> List[Dict[str, Any]]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT githash, projectname, owner, author, filehashmap, projectfile, time
-            FROM githashdb
-            WHERE owner = ? AND projectname = ?
-            ORDER BY time DESC
-            LIMIT ? OFFSET ?
-            """,
-            (owner, projectname, limit, offset)
-        )
-        rows = cursor.fetchall()
+    def list_commits(self, owner: str, projectname: str, offset: int, limit: int, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        columns = _release_columns(fields, _COMMIT_FIELDS)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                SELECT {_release_select(columns)}
+                FROM githashdb
+                WHERE owner = ? AND projectname = ?
+                ORDER BY time DESC, id DESC
+                LIMIT ? OFFSET ?
+                """,
+                (owner, projectname, limit, offset)
+            )
+            rows = cursor.fetchall()
         releases = self._rows_to_releases(rows)
-        conn.close()
         return releases
 
+    def list_commits_after(self, owner: str, projectname: str, after: Optional[Tuple[str, int]], limit: int, fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+        """
+        游标分页: 返回排在 after=(time, id) 之后的 limit 个提交, 以及下一页的游标
+        深页与首页代价相同, 不需要跳过 offset 行
+        """
+        columns = _release_columns(fields, _COMMIT_FIELDS)
+        # 游标需要 time 与 id, 未请求 time 时取出后再去掉
+        select = ['id'] + [col for col in columns if col != 'id']
+        if 'time' not in select:
+            select.append('time')
+        with self._connection() as conn:
+            if after is None:
+                cursor = conn.execute(
+                    f"""
+                    SELECT {_release_select(select)}
+                    FROM githashdb
+                    WHERE owner = ? AND projectname = ?
+                    ORDER BY time DESC, id DESC LIMIT ?
+                    """,
+                    (owner, projectname, limit + 1)
+                )
+            else:
+                cursor = conn.execute(
+                    f"""
+                    SELECT {_release_select(select)}
+                    FROM githashdb
+                    WHERE owner = ? AND projectname = ? AND (time, id) < (?, ?)
+                    ORDER BY time DESC, id DESC LIMIT ?
+                    """,
+                    (owner, projectname, after[0], after[1], limit + 1)
+                )
+            rows = cursor.fetchall()
+        releases, next_key = self._keyset_page(rows, limit, keep_id='id' in columns)
+        for row_dict in releases:
+            if 'time' not in columns:
+                row_dict.pop('time')
+            _decode_release(row_dict)
+        return releases, next_key
+
 
 if __name__ == "__main__":
+    import sys
     db = DB()
     db.init_db()
-    import sys
     if '-t1' in sys.argv:
         db.add_filehash(["hash1", "hash2", "hash3"])
         db.submit_release(
@@ -468,11 +1306,80 @@ if __name__ == "__main__":
         db.add_filehash(["hash1", "hash2", "hash3"])
         print(db.query_filehash(["hash1", "hash3", "hash1", "hash4"]))
         print(db.find_matching_filehash(["hash3", "hash2", "hash3", "hash4"]))
+    if '-t4' in sys.argv:
+        # EXPLAIN QUERY PLAN 回归检查: 跑一遍各个 API 查询, 任何一条退化为全表扫描即失败
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            statements = []
+            tdb = DB(os.path.join(tmp, 'plan.db'), trace_callback=statements.append)
+            tdb.init_db()
+            statements.clear()
+            tdb.add_filehash(["hash1", "hash2"])
+            tdb.submit_release("g1", "p", "o", "a", {"file1": "hash1", "file2": "hash2"}, {"a": {}}, "2024-06-01 12:00:00")
+            tdb.submit_release("g1", "p", "o", "a", {"file1": "hash1"}, {"a": {}}, "2024-06-01 12:00:01")
+            tdb.submit_release_delta("g2", "p", "o", "a", "g1", {"file2": "hash2"}, {"b": {}}, "2024-06-01 12:00:02")
+            tdb.submit_merge([("o", "p", "g1"), ("o", "p", "g2")], "g3", "p", "o", "a", "2024-06-01 12:00:03")
+            tdb.diff_releases(2, 3)
+            tdb.list_filehash_releases("hash1", None, 20)
+            tdb.list_filehash_releases("hash1", (3, "file1"), 20)
+            tdb.list_path_history("o", "p", "file1", None, 20)
+            tdb.list_path_history("o", "p", "file1", ("2024-06-01 12:00:03", 3), 20, changes_only=True)
+            tdb.find_exact_match("g1", "p", "o")
+            tdb.query_filehash(["hash1", "hash2"])
+            tdb.find_matching_filehash(["hash1", "hash3"])
+            tdb.list_filehash_since(0, 20)
+            tdb.list_filehash_after(0, 20, "9999-01-01")
+            tdb.delete_unreferenced_filehash(["hash1", "hash3"])
+            tdb.list_owners()
+            tdb.count_projects_global()
+            tdb.list_projects_global(0, 20)
+            tdb.count_projects_by_owner("o")
+            tdb.list_projects_by_owner("o", 0, 20)
+            tdb.count_commits("o", "p")
+            tdb.list_commits("o", "p", 0, 20)
+            tdb.list_projects_global_after(("2024-06-01 12:00:01", 1), 20)
+            tdb.list_projects_by_owner_after("o", ("2024-06-01 12:00:01", 1), 20)
+            tdb.list_commits_after("o", "p", ("2024-06-01 12:00:01", 2), 20)
+            tdb.delete_release("g1", "p", "o")
+            tdb.delete_release("g2", "p", "o")
+            tdb.delete_release("g3", "p", "o")
+            scans = tdb.explain_table_scans(statements)
+            tdb.close()
+        for sql, detail in scans:
+            print(f'{detail}: {sql.strip()}')
+        if scans:
+            sys.exit(1)
+        print('ok')
+    if '-t5' in sys.argv:
+        # filehashmap 块与 projectfile 文件内容相同时, 块中的对象仍要算作被引用
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            tdb = DB(os.path.join(tmp, 'kind.db'))
+            tdb.init_db()
+            tdb.add_filehash(["hash1"])
+            tdb.submit_release("g1", "p", "o", "a", {}, {"x": {"file1": "hash1"}}, "2024-06-01 12:00:00")
+            tdb.submit_release("g2", "p", "o", "a", {"file1": "hash1"}, {"x": {"file1": "hash1"}}, "2024-06-01 12:00:01")
+            failures = []
+            if not tdb.list_filehash_after(0, 10, "9999-01-01")[0]['referenced']:
+                failures.append('list_filehash_after: hash1 not referenced')
+            if tdb.delete_unreferenced_filehash(["hash1"]):
+                failures.append('delete_unreferenced_filehash: deleted hash1')
+            releases, _ = tdb.list_filehash_releases("hash1", None, 20)
+            if [row['githash'] for row in releases] != ["g2"]:
+                failures.append(f'list_filehash_releases: {releases}')
+            history, _ = tdb.list_path_history("o", "p", "file1", None, 20)
+            if [row['filehash'] for row in history] != ["hash1", None]:
+                failures.append(f'list_path_history: {history}')
+            if tdb.query_filehash(["hash1"])["hash1"] != ["o/p/g2/file1"]:
+                failures.append(f'query_filehash: {tdb.query_filehash(["hash1"])}')
+            tdb.close()
+        for failure in failures:
+            print(failure)
+        if failures:
+            sys.exit(1)
+        print('ok')
     if '-c' in sys.argv:
         # clear db
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM githashdb")
-        cursor.execute("DELETE FROM filehashdb")
-        conn.commit()
-        conn.close()
\ No newline at end of file
+        with db._transaction() as conn:
+            conn.execute("DELETE FROM githashdb")
+            conn.execute("DELETE FROM filehashdb")
\ No newline at end of file
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+压测脚本: 在若干并发大文件下载进行时测量 /api/projects 的延迟
+
+先启动服务 (python server.py 或 uvicorn asgi:app), 再运行
+python loadtest.py [http://127.0.0.1:13496] [-size 2G] [-pulls 8] [-seconds 30] [-clients 4] [-rate 0]
+
+-size     下载用对象的大小, 不存在时先以 PUT /objects 上传 (内容确定, 重复运行不会重复上传)
+-pulls    并发下载数, 每个下载结束后立即重新开始
+-seconds  每个阶段的时长; 先测无下载时的基线, 再测并发下载时
+-clients  并发请求 /api/projects 的客户端数
+-rate     每个下载的限速 (字节/秒, 0 为不限), 模拟慢速客户端
+"""
+
+import sys
+import time
+import random
+import hashlib
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _argv_value(flag, default=None):
+    if flag in sys.argv:
+        i = sys.argv.index(flag)
+        if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith('-'):
+            return sys.argv[i + 1]
+    return default
+
+
+def parse_size(s: str) -> int:
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    s = s.upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def iter_payload(size: int):
+    # 1MB 随机块重复, 开头不可压缩, 服务端会原样存放
+    block = random.Random(0).randbytes(CHUNK_SIZE)
+    remaining = size
+    while remaining > 0:
+        yield block[:min(remaining, CHUNK_SIZE)]
+        remaining -= CHUNK_SIZE
+
+
+def payload_hash(size: int) -> str:
+    hasher = hashlib.sha256()
+    for chunk in iter_payload(size):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class Target:
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+
+    def connect(self, timeout: float = 600) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+
+def ensure_object(target: Target, size: int) -> str:
+    hashk = payload_hash(size)
+    conn = target.connect()
+    conn.request('GET', '/objects/' + hashk, headers={'Range': 'bytes=0-0'})
+    response = conn.getresponse()
+    response.read()
+    if response.status != 206:
+        t0 = time.perf_counter()
+        conn.request('PUT', '/objects/' + hashk, body=iter_payload(size), headers={'Content-Length': str(size)})
+        response = conn.getresponse()
+        print(f'uploaded {size} bytes in {time.perf_counter() - t0:.1f}s: {response.read()[:200]!r}')
+    conn.close()
+    return hashk
+
+
+def pull_loop(target: Target, hashk: str, rate: int, stop: threading.Event, stats: dict, lock: threading.Lock):
+    conn = target.connect()
+    while not stop.is_set():
+        conn.request('GET', '/objects/' + hashk)
+        response = conn.getresponse()
+        t0 = time.perf_counter()
+        received = 0
+        while not stop.is_set():
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+            with lock:
+                stats['bytes'] += len(chunk)
+            if rate:
+                delay = received / rate - (time.perf_counter() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+        if stop.is_set():
+            break
+        with lock:
+            stats['pulls'] += 1
+    conn.close()
+
+
+def api_loop(target: Target, stop: threading.Event, latencies: list, errors: list):
+    conn = target.connect(timeout=60)
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        try:
+            conn.request('GET', '/api/projects?page=1&size=20')
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = target.connect(timeout=60)
+            continue
+        latencies.append(time.perf_counter() - t0)
+    conn.close()
+
+
+def run_phase(name, target, seconds, clients, hashk=None, pulls=0, rate=0):
+    stop = threading.Event()
+    latencies, errors = [], []
+    stats, lock = {'bytes': 0, 'pulls': 0}, threading.Lock()
+    threads = [threading.Thread(target=pull_loop, args=(target, hashk, rate, stop, stats, lock), daemon=True) for _ in range(pulls)]
+    for t in threads:
+        t.start()
+    if pulls:
+        time.sleep(1)
+        with lock:
+            stats['bytes'] = 0
+    api_threads = [threading.Thread(target=api_loop, args=(target, stop, latencies, errors), daemon=True) for _ in range(clients)]
+    for t in api_threads:
+        t.start()
+    t0 = time.perf_counter()
+    time.sleep(seconds)
+    stop.set()
+    elapsed = time.perf_counter() - t0
+    for t in api_threads + threads:
+        t.join()
+    latencies.sort()
+    print(
+        f'{name:<24} requests={len(latencies)} errors={len(errors)} '
+        f'p50={percentile(latencies, 50) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms '
+        f'max={(latencies[-1] if latencies else 0) * 1000:.1f}ms'
+        + (f' pulled={stats["bytes"] / elapsed / (1 << 20):.1f}MB/s complete={stats["pulls"]}' if pulls else '')
+    )
+
+
+if __name__ == '__main__':
+    url = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith('-') else 'http://127.0.0.1:13496'
+    target = Target(url)
+    size = parse_size(_argv_value('-size', '2G'))
+    pulls = int(_argv_value('-pulls', 8))
+    seconds = float(_argv_value('-seconds', 30))
+    clients = int(_argv_value('-clients', 4))
+    rate = parse_size(_argv_value('-rate', '0'))
+    hashk = ensure_object(target, size)
+    run_phase('baseline', target, seconds, clients)
+    run_phase(f'during {pulls} pulls', target, seconds, clients, hashk, pulls, rate)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+对象垃圾回收 (mark-and-sweep)
+
+1. 遍历 filehashdb: 不再被任何 release 引用的条目删除, 其对象文件随之删除;
+   对象文件已丢失的条目也删除, 让客户端下次 /checkFile 时重新上传
+2. 遍历 objs: filehashdb 中没有记录的对象文件删除
+3. 删除遗留的上传临时文件
+
+只处理早于宽限期 (grace 秒) 的条目和文件: 上传流程是先落盘对象再写 filehashdb,
+之后才 /submitRelease, 宽限期内的对象视为上传中; 删除前再检查一次 mtime, 期间被重新上传的对象保留
+
+python objgc.py [-n] [-grace 86400] [-d data/objs] [-db data/data.db]   -n 只统计不删除
+"""
+
+import os
+import sys
+import time
+import threading
+from typing import Any, Dict, List
+
+import db as db_module
+import objstore
+
+DEFAULT_GRACE = 24 * 3600
+BATCH_SIZE = 500
+
+
+def _utc(ts: float) -> str:
+    # filehashdb.time 由 CURRENT_TIMESTAMP 写入, 为 UTC
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def _sweep_filehashdb(db: db_module.DB, store: objstore.ObjectStore, cutoff: float, dry_run: bool, report: Dict[str, Any]):
+    after = 0
+    while True:
+        rows = db.list_filehash_after(after, BATCH_SIZE, _utc(cutoff))
+        if not rows:
+            return
+        after = rows[-1]['id']
+        dead = {}
+        dangling = []
+        for row in rows:
+            obj = store.locate(row['filehash'])
+            if obj is None:
+                dangling.append(row['filehash'])
+                if row['referenced']:
+                    report['missing'].append(row['filehash'])
+            elif not row['referenced'] and _mtime(obj.path) < cutoff:
+                dead[row['filehash']] = obj
+        report['dangling_rows'] += len(dangling)
+        if dry_run:
+            report['rows_deleted'] += len(dead)
+            report['objects_deleted'] += len(dead)
+            report['bytes_reclaimed'] += sum(os.path.getsize(obj.path) for obj in dead.values())
+            continue
+        if dangling:
+            db.delete_filehash(dangling)
+        for hashk in db.delete_unreferenced_filehash(list(dead)):
+            report['rows_deleted'] += 1
+            freed = store.remove(dead[hashk], before=cutoff)
+            if freed:
+                report['objects_deleted'] += 1
+                report['bytes_reclaimed'] += freed
+
+
+def _sweep_objects(db: db_module.DB, store: objstore.ObjectStore, cutoff: float, dry_run: bool, report: Dict[str, Any]):
+    def flush(batch: List[objstore.StoredObject]):
+        known = set(db.find_matching_filehash([obj.hashk for obj in batch]))
+        for obj in batch:
+            if obj.hashk in known:
+                continue
+            if dry_run:
+                if _mtime(obj.path) < cutoff:
+                    report['objects_deleted'] += 1
+                    report['bytes_reclaimed'] += os.path.getsize(obj.path)
+                continue
+            freed = store.remove(obj, before=cutoff)
+            if freed:
+                report['objects_deleted'] += 1
+                report['bytes_reclaimed'] += freed
+
+    batch = []
+    for obj in store.iter_objects():
+        report['objects_scanned'] += 1
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    for entry in store.iter_tmp():
+        st = entry.stat()
+        if st.st_mtime >= cutoff:
+            continue
+        if not dry_run:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+        report['tmp_deleted'] += 1
+        report['bytes_reclaimed'] += st.st_size
+
+
+def collect(db: db_module.DB, store: objstore.ObjectStore, grace: float = DEFAULT_GRACE, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    执行一轮 GC, 返回统计: 删除的条目/对象/临时文件数, 回收的字节数, 被引用但文件丢失的 hash, 耗时
+    """
+    t0 = time.perf_counter()
+    cutoff = time.time() - grace
+    report = {
+        'rows_deleted': 0,
+        'dangling_rows': 0,
+        'objects_scanned': 0,
+        'objects_deleted': 0,
+        'tmp_deleted': 0,
+        'bytes_reclaimed': 0,
+        'missing': [],
+        'dry_run': dry_run,
+    }
+    _sweep_filehashdb(db, store, cutoff, dry_run, report)
+    _sweep_objects(db, store, cutoff, dry_run, report)
+    report['elapsed'] = time.perf_counter() - t0
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    return (
+        f"{'[dry run] ' if report['dry_run'] else ''}"
+        f"{report['objects_scanned']} objects scanned, "
+        f"{report['rows_deleted']} rows / {report['objects_deleted']} objects / {report['tmp_deleted']} tmp files deleted, "
+        f"{report['dangling_rows']} dangling rows, {len(report['missing'])} referenced objects missing, "
+        f"{report['bytes_reclaimed']} bytes reclaimed, {report['elapsed']:.2f}s"
+    )
+
+
+class GCThread(threading.Thread):
+    """
+    后台定期执行 GC 的守护线程, 每 interval 秒一轮
+    """
+    def __init__(self, db: db_module.DB, store: objstore.ObjectStore, interval: float, grace: float = DEFAULT_GRACE):
+        super().__init__(name='objgc', daemon=True)
+        self.db = db
+        self.store = store
+        self.interval = interval
+        self.grace = grace
+        self.last_report = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.last_report = collect(self.db, self.store, self.grace)
+                print('gc: ' + format_report(self.last_report))
+            except Exception as e:
+                print('gc failed: ' + str(e))
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def _argv_value(flag, default=None):
+    if flag in sys.argv:
+        i = sys.argv.index(flag)
+        if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith('-'):
+            return sys.argv[i + 1]
+    return default
+
+
+if __name__ == '__main__':
+    base = os.path.abspath(os.path.dirname(__file__))
+    db = db_module.DB(_argv_value('-db', os.path.join(base, 'data', 'data.db')))
+    db.init_db()
+    store = objstore.ObjectStore(_argv_value('-d', objstore.DATA_OBJS_DIR))
+    report = collect(db, store, float(_argv_value('-grace', DEFAULT_GRACE)), dry_run='-n' in sys.argv)
+    for hashk in report['missing']:
+        print('missing: ' + hashk)
+    print(format_report(report))
@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+对象存储: data/objs 下以内容 hash 命名的数据对象
+
+目录布局可插拔:
+    flat     objs/<hash>.bin
+    sharded  objs/ab/cd/<hash>.bin   (默认, 百万级对象时目录项不会堆在同一目录)
+读取时先查当前布局, 再查 fallback 布局, 因此可以在服务运行中在线迁移
+
+可压缩的对象以 <hash>.bin.gz (gzip) 或 <hash>.bin.zst (zstd, 需要安装 zstandard) 存放,
+hash 始终是原始内容的 hash; 是否压缩由大小与抽样压缩率决定
+
+python objstore.py -verify [-j 8] [-a sha256]    并行重新计算所有对象的 hash, 报告损坏对象与吞吐量
+python objstore.py -migrate sharded [-j 16]      把所有对象移动到指定布局
+python objstore.py -compress [gzip|zstd] [-j 4]  把现有未压缩对象中值得压缩的压缩存放
+"""
+
+import os
+import re
+import sys
+import gzip
+import zlib
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DATA_OBJS_DIR = os.path.join(BASE_DIR, 'data', 'objs')
+
+# 与客户端计算文件 hash 的算法一致; 为空时不校验上传内容
+DEFAULT_HASH_ALGORITHM = 'sha256'
+CHUNK_SIZE = 1024 * 1024
+OBJ_SUFFIX = '.bin'
+# 上传中的临时文件建在 objs 根目录下, 以此为前缀
+TMP_PREFIX = '.upload-'
+
+# 压缩编码 -> 文件后缀, 编码名与 HTTP Content-Encoding 一致
+ENCODING_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MAX_SIZE = (1 << 32) - 1   # gzip 尾部只记录 32 位原始长度
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_MAX_RATIO = 0.9
+
+_HASH_RE = re.compile(r'^[0-9A-Za-z_-]{1,128}$')
+
+def is_valid_hash(hashk) -> bool:
+    # hash 直接用作文件名, 不允许出现路径分隔符等字符
+    return isinstance(hashk, str) and _HASH_RE.match(hashk) is not None
+
+
+# path 为磁盘上的文件, encoding 为 None (原样存放) 或 ENCODING_SUFFIXES 中的编码
+StoredObject = namedtuple('StoredObject', ['hashk', 'path', 'encoding'])
+
+
+class HashMismatch(ValueError):
+    def __init__(self, expected, actual):
+        super().__init__(f'hash mismatch: expected {expected}, got {actual}')
+        self.expected = expected
+        self.actual = actual
+
+
+def new_hasher(algorithm: Optional[str]):
+    return hashlib.new(algorithm) if algorithm else None
+
+
+def default_compression() -> str:
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def open_decoded(path: str, encoding: Optional[str]) -> BinaryIO:
+    """
+    打开对象文件, 读出的是原始内容
+    """
+    if encoding is None:
+        return open(path, 'rb')
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read ' + path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    raise ValueError(f'unknown encoding: {encoding}')
+
+
+def decoded_size(path: str, encoding: Optional[str]) -> int:
+    """
+    原始内容的字节数, 不解压: gzip 取尾部 ISIZE, zstd 取帧头中的 content size
+    """
+    if encoding is None:
+        return os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if encoding == 'gzip':
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+        if encoding == 'zstd':
+            size = zstandard.frame_content_size(f.read(18))
+            if size < 0:
+                raise ValueError('zstd frame without content size: ' + path)
+            return size
+    raise ValueError(f'unknown encoding: {encoding}')
+
+
+def hash_file(path: str, algorithm: str = DEFAULT_HASH_ALGORITHM, encoding: Optional[str] = None) -> Tuple[str, int]:
+    """
+    分块计算文件 (解码后) 内容的 hash, 返回 (hexdigest, 字节数)
+    """
+    hasher = hashlib.new(algorithm)
+    size = 0
+    with open_decoded(path, encoding) as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def worth_compressing(path: str) -> bool:
+    """
+    大小在区间内, 且开头 64KB 用 zlib 最快档压缩后不超过原来的 90%
+    """
+    size = os.path.getsize(path)
+    if size < COMPRESS_MIN_SIZE or size > COMPRESS_MAX_SIZE:
+        return False
+    with open(path, 'rb') as f:
+        sample = f.read(COMPRESS_SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) <= len(sample) * COMPRESS_MAX_RATIO
+
+
+def compress_file(src_path: str, dst: BinaryIO, encoding: str):
+    size = os.path.getsize(src_path)
+    with open(src_path, 'rb') as src:
+        if encoding == 'gzip':
+            with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6, mtime=0) as gz:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    gz.write(chunk)
+        elif encoding == 'zstd':
+            # 写入 content size, 打包下载时不解压就能知道原始长度
+            zstandard.ZstdCompressor(level=3, write_content_size=True).copy_stream(src, dst, size=size)
+        else:
+            raise ValueError(f'unknown encoding: {encoding}')
+
+
+class HashingTempFile:
+    """
+    写入时顺带计算 hash 的临时文件, 建在目标目录下以便 os.replace 原子改名
+    可直接作为 werkzeug 的 stream_factory 返回值, 其余文件方法透传给底层临时文件
+    """
+    def __init__(self, dirpath: str, algorithm: Optional[str]):
+        self._file = tempfile.NamedTemporaryFile(dir=dirpath, prefix=TMP_PREFIX, suffix='.tmp', delete=False)
+        self._hasher = new_hasher(algorithm)
+        self.name = self._file.name
+        self.size = 0
+
+    def write(self, data):
+        if self._hasher is not None:
+            self._hasher.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> Optional[str]:
+        return self._hasher.hexdigest() if self._hasher is not None else None
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def verify(self, expected: Optional[str]):
+        """
+        hash 与 expected 不一致时删除临时文件并抛出 HashMismatch
+        """
+        actual = self.hexdigest()
+        if expected is not None and actual is not None and actual != expected.lower():
+            self.discard()
+            raise HashMismatch(expected, actual)
+
+    def commit(self, path: str, expected: Optional[str] = None):
+        """
+        校验 hash 后 fsync 并原子改名为 path
+        """
+        self.verify(expected)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.name, path)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+
+class FlatLayout:
+    name = 'flat'
+
+    def relpath(self, hashk: str) -> str:
+        return hashk + OBJ_SUFFIX
+
+
+class ShardedLayout:
+    """
+    以 hash 前缀分两级子目录: ab/cd/<hash>.bin
+    """
+    name = 'sharded'
+
+    def __init__(self, levels: int = 2, width: int = 2):
+        self.levels = levels
+        self.width = width
+
+    def relpath(self, hashk: str) -> str:
+        padded = hashk.ljust(self.levels * self.width, '_')
+        shards = [padded[i * self.width:(i + 1) * self.width] for i in range(self.levels)]
+        return os.path.join(*shards, hashk + OBJ_SUFFIX)
+
+
+LAYOUTS = {
+    'flat': FlatLayout,
+    'sharded': ShardedLayout,
+}
+
+
+def _parse_object_name(name: str) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    文件名 -> (hash, encoding); 不是对象文件 (例如上传中的临时文件) 时返回 None
+    """
+    if name.startswith('.'):
+        return None
+    if name.endswith(OBJ_SUFFIX):
+        return name[:-len(OBJ_SUFFIX)], None
+    for encoding, suffix in ENCODING_SUFFIXES.items():
+        if name.endswith(OBJ_SUFFIX + suffix):
+            return name[:-len(OBJ_SUFFIX + suffix)], encoding
+    return None
+
+
+class ObjectStore:
+    """
+    以内容 hash 寻址的对象存储
+    layout 决定新对象写到哪里; fallback 中的布局只用于读取尚未迁移的旧对象
+    compression 为 None 时原样存放, 否则对值得压缩的对象以该编码存放
+    """
+    def __init__(self, root: str = DATA_OBJS_DIR, layout: str = 'sharded', fallback: Tuple[str, ...] = ('flat',), algorithm: Optional[str] = DEFAULT_HASH_ALGORITHM, compression: Optional[str] = None):
+        self.root = root
+        self.layout = LAYOUTS[layout]()
+        self.fallback = [LAYOUTS[name]() for name in fallback if name != layout]
+        self.algorithm = algorithm
+        if compression == 'zstd' and zstandard is None:
+            compression = 'gzip'
+        self.compression = compression
+
+    def path(self, hashk: str) -> str:
+        """
+        对象 (未压缩时) 在当前布局下应在的位置
+        """
+        return os.path.join(self.root, self.layout.relpath(hashk))
+
+    def _probe(self, hashk: str, base: str) -> Optional[StoredObject]:
+        if os.path.isfile(base):
+            return StoredObject(hashk, base, None)
+        for encoding, suffix in ENCODING_SUFFIXES.items():
+            if os.path.isfile(base + suffix):
+                return StoredObject(hashk, base + suffix, encoding)
+        return None
+
+    def locate(self, hashk: str) -> Optional[StoredObject]:
+        """
+        返回对象在磁盘上的位置与编码, 不存在或 hash 非法时返回 None
+        最后再查一次主布局, 避免与在线迁移的改名交错而漏掉
+        """
+        if not is_valid_hash(hashk):
+            return None
+        primary = self.path(hashk)
+        found = self._probe(hashk, primary)
+        if found:
+            return found
+        for layout in self.fallback:
+            found = self._probe(hashk, os.path.join(self.root, layout.relpath(hashk)))
+            if found:
+                return found
+        if self.fallback:
+            return self._probe(hashk, primary)
+        return None
+
+    def remove(self, obj: StoredObject, before: Optional[float] = None) -> int:
+        """
+        删除对象文件, 返回释放的字节数
+        before 不为空时, 文件在该时刻之后被修改过 (例如刚被重新上传) 则不删除, 返回 0:
+        先改名为墓碑再检查 mtime, 检查之后完成的重新上传落在原路径上, 不会被删掉;
+        检查之前完成的被改名的正是新文件, 放回原处 (内容相同, 期间又有上传覆盖也无妨)
+        墓碑以 TMP_PREFIX 开头, 进程在中途退出时由 GC 按临时文件清理
+        """
+        try:
+            if before is None:
+                st = os.stat(obj.path)
+                os.unlink(obj.path)
+                return st.st_size
+            tomb = os.path.join(self.root, f'{TMP_PREFIX}{os.path.basename(obj.path)}.{os.getpid()}.{threading.get_ident()}.gc')
+            os.rename(obj.path, tomb)
+        except FileNotFoundError:
+            return 0
+        st = os.stat(tomb)
+        if st.st_mtime >= before:
+            os.replace(tomb, obj.path)
+            return 0
+        os.unlink(tomb)
+        return st.st_size
+
+    def iter_tmp(self) -> Iterator[os.DirEntry]:
+        """
+        根目录下的上传临时文件, 包括进程崩溃后遗留的
+        """
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.startswith(TMP_PREFIX) and entry.is_file(follow_symlinks=False):
+                    yield entry
+
+    def open(self, obj: StoredObject) -> BinaryIO:
+        return open_decoded(obj.path, obj.encoding)
+
+    def size(self, obj: StoredObject) -> int:
+        return decoded_size(obj.path, obj.encoding)
+
+    def open_tmp(self, *args, **kwargs) -> HashingTempFile:
+        """
+        新建上传用临时文件, 参数被忽略, 以便直接用作 werkzeug 的 stream_factory
+        """
+        return HashingTempFile(self.root, self.algorithm)
+
+    def commit(self, tmp: HashingTempFile, hashk: str):
+        if not is_valid_hash(hashk):
+            tmp.discard()
+            raise ValueError(f'invalid hash: {hashk}')
+        tmp.verify(hashk)
+        path = self.path(hashk)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.compression:
+            tmp.flush()
+            if worth_compressing(tmp.name):
+                try:
+                    self._store_compressed(tmp.name, path, self.compression)
+                finally:
+                    tmp.discard()
+                return
+        tmp.commit(path, hashk)
+
+    def _store_compressed(self, src_path: str, path: str, encoding: str):
+        """
+        把 src_path 压缩后原子地存为 path + 编码后缀
+        """
+        ctmp = HashingTempFile(self.root, None)
+        try:
+            compress_file(src_path, ctmp, encoding)
+            ctmp.commit(path + ENCODING_SUFFIXES[encoding])
+        except:
+            ctmp.discard()
+            raise
+
+    def iter_objects(self) -> Iterator[StoredObject]:
+        """
+        遍历所有布局下的对象; 上传中的临时文件不计入
+        """
+        stack = [self.root]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    parsed = _parse_object_name(entry.name)
+                    if parsed:
+                        yield StoredObject(parsed[0], entry.path, parsed[1])
+
+    def _move(self, obj: StoredObject) -> bool:
+        target = self.path(obj.hashk) + (ENCODING_SUFFIXES[obj.encoding] if obj.encoding else '')
+        if obj.path == target:
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(obj.path, target)
+        return True
+
+    def migrate(self, workers: int = 16) -> int:
+        """
+        把所有不在当前布局下的对象移动过去, 返回移动的数量
+        os.replace 在同一文件系统内是原子的, 迁移期间读取依靠 locate 的 fallback 不受影响
+        """
+        t0 = time.perf_counter()
+        moved = 0
+        total = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for i, did_move in enumerate(pool.map(self._move, self.iter_objects()), 1):
+                total = i
+                moved += did_move
+                if i % 100000 == 0:
+                    print(f'{i} objects scanned, {moved} moved')
+        elapsed = time.perf_counter() - t0
+        print(f'{total} objects, {moved} moved to {self.layout.name}, {elapsed:.2f}s')
+        return moved
+
+    def _recompress(self, obj: StoredObject) -> int:
+        if obj.encoding is not None or not worth_compressing(obj.path):
+            return 0
+        before = os.path.getsize(obj.path)
+        base = obj.path
+        self._store_compressed(obj.path, base, self.compression)
+        after = os.path.getsize(base + ENCODING_SUFFIXES[self.compression])
+        # 压缩版本已就位后再删原文件, 期间读取总能找到其中之一
+        os.unlink(obj.path)
+        return before - after
+
+    def recompress(self, workers: int = 4) -> int:
+        """
+        把现有未压缩对象中值得压缩的压缩存放, 返回节省的字节数
+        zlib / zstd 压缩时释放 GIL, 用线程池即可并行
+        """
+        if not self.compression:
+            raise ValueError('compression is not configured')
+        t0 = time.perf_counter()
+        saved = 0
+        total = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for i, delta in enumerate(pool.map(self._recompress, self.iter_objects()), 1):
+                total = i
+                saved += delta
+                if i % 10000 == 0:
+                    print(f'{i} objects scanned, {saved} bytes saved')
+        elapsed = time.perf_counter() - t0
+        print(f'{total} objects, {saved} bytes saved with {self.compression}, {elapsed:.2f}s')
+        return saved
+
+
+def _verify_one(args):
+    obj, algorithm = args
+    try:
+        actual, size = hash_file(obj.path, algorithm, obj.encoding)
+    except (OSError, ValueError, RuntimeError, EOFError, zlib.error) as e:
+        return obj.path, False, 0, str(e)
+    return obj.path, actual == obj.hashk.lower(), size, actual
+
+
+def verify_store(store: ObjectStore, algorithm: str = DEFAULT_HASH_ALGORITHM, workers: Optional[int] = None) -> List[str]:
+    """
+    用进程池并行重算 store 中所有对象的 hash, 打印进度与吞吐量, 返回损坏对象的路径
+    """
+    items = [(obj, algorithm) for obj in store.iter_objects()]
+    corrupt = []
+    total_bytes = 0
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, (path, ok, size, detail) in enumerate(pool.map(_verify_one, items, chunksize=64), 1):
+            total_bytes += size
+            if not ok:
+                corrupt.append(path)
+                print(f'corrupt: {path} ({detail})')
+            if i % 10000 == 0:
+                print(f'{i}/{len(items)} objects checked')
+    elapsed = time.perf_counter() - t0
+    rate = total_bytes / elapsed / (1 << 20) if elapsed > 0 else 0.0
+    print(f'{len(items)} objects, {total_bytes} bytes, {len(corrupt)} corrupt, {elapsed:.2f}s, {rate:.1f} MB/s, {len(items) / elapsed if elapsed > 0 else 0:.0f} objects/s')
+    return corrupt
+
+
+def _argv_value(flag, default=None):
+    if flag in sys.argv:
+        i = sys.argv.index(flag)
+        if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith('-'):
+            return sys.argv[i + 1]
+    return default
+
+
+if __name__ == '__main__':
+    root = _argv_value('-d', DATA_OBJS_DIR)
+    workers = _argv_value('-j')
+    if '-verify' in sys.argv:
+        corrupt = verify_store(
+            ObjectStore(root),
+            _argv_value('-a', DEFAULT_HASH_ALGORITHM),
+            int(workers) if workers else None,
+        )
+        if corrupt:
+            sys.exit(1)
+    if '-migrate' in sys.argv:
+        ObjectStore(root, layout=_argv_value('-migrate', 'sharded')).migrate(int(workers) if workers else 16)
+    if '-compress' in sys.argv:
+        ObjectStore(root, compression=_argv_value('-compress', default_compression())).recompress(int(workers) if workers else 4)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+生产环境多进程启动器 (仅 POSIX)
+
+python prefork.py [-w 进程数] [-p 端口]
+
+主进程持文件锁完成 schema 迁移后监听端口, 再 fork 出 N 个 worker (默认 CPU 核数), worker 异常退出时重新拉起
+worker 预热缓存后才开始在共享的监听 socket 上 accept, 连接由内核在各 worker 间分配
+SIGTERM / SIGINT: 主进程转发给 worker, worker 停止 accept, 等处理中的请求完成后退出; 超过 c.shutdown_timeout 秒仍未退出的强制结束
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import threading
+
+from werkzeug.serving import make_server
+
+import objgc
+import server
+from server import app, c
+
+# worker 启动后不到这么多秒就退出视为启动失败, 重启前等待, 避免反复 fork
+RESPAWN_DELAY = 1.0
+
+
+def worker_main(sock: socket.socket, index: int) -> int:
+    httpd = make_server(c.ip, sock.getsockname()[1], app, threaded=True, fd=sock.fileno())
+    # 关闭时等待处理中的请求线程结束
+    httpd.daemon_threads = False
+
+    def stop(signum, frame):
+        # shutdown() 会等待 serve_forever 退出, 不能在 serve_forever 所在的线程里直接调用
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    server.warm_caches()
+    if index == 0 and c.gc_interval:
+        c.gc_thread = objgc.GCThread(c.db, c.objs, c.gc_interval, c.gc_grace)
+        c.gc_thread.start()
+    server.p(f'worker {index} (pid {os.getpid()}) 已启动')
+    httpd.serve_forever()
+    httpd.server_close()
+    if c.gc_thread is not None:
+        c.gc_thread.stop()
+    c.db.close()
+    return 0
+
+
+class Arbiter:
+    def __init__(self, sock: socket.socket, workers: int):
+        self.sock = sock
+        self.workers = workers
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = worker_main(self.sock, index)
+            finally:
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic())
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        server.p('正在停止...')
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(c.shutdown_timeout)
+
+    def kill(self, signum, frame):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            server.p(f'worker {index} (pid {pid}) 退出, 状态 {status}, 重新启动')
+            if time.monotonic() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            self.spawn(index)
+        self.sock.close()
+
+
+def _argv_value(flag, default=None):
+    if flag in sys.argv:
+        i = sys.argv.index(flag)
+        if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith('-'):
+            return sys.argv[i + 1]
+    return default
+
+
+if __name__ == '__main__':
+    os.chdir(server.ROOT_DIR)
+    workers = int(_argv_value('-w', c.workers or os.cpu_count() or 1))
+    port = int(_argv_value('-p', c.port))
+    c.db.init_db_once(server.INIT_LOCK_PATH)
+    # 主进程不处理请求, fork 之前关闭迁移用过的连接
+    c.db.close()
+    sock = socket.create_server((c.ip, port), backlog=1024)
+    server.p(f'服务已启动, {workers} 个 worker, 端口 {port}')
+    Arbiter(sock, workers).run()
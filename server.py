@@ -5,23 +5,64 @@ import json
 import os
 import shutil
 import base64
+import tarfile
+import threading
 
-from flask import Flask, request, Response, abort
-import mimetypes
+from flask import Flask, request, Response, abort, send_file
+from werkzeug.formparser import parse_form_data
 
 import db as db_module
+import objstore
+import cache
+import objgc
+import staticfiles
 
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 DATA_OBJS_DIR = os.path.join(BASE_DIR, 'data', 'objs')
 DB_PATH = os.path.join(BASE_DIR, 'data', 'data.db')
+# 多进程启动时 schema 迁移用的文件锁, 以及各 worker 共享的 release 缓存失效标记
+INIT_LOCK_PATH = os.path.join(BASE_DIR, 'data', '.init.lock')
+RELEASE_CACHE_GEN_PATH = os.path.join(BASE_DIR, 'data', '.release-cache')
+# 静态文件预压缩的 gzip / br 版本, 以内容 hash 命名
+STATIC_CACHE_DIR = os.path.join(BASE_DIR, 'data', '.static')
 
 class c:
     ip='0.0.0.0'
     port=13496
     error_format='error format'
+    invalid_hash='invalid hash'
+    hash_mismatch='hash mismatch'
+    obj_chunk_size=1024*1024
+    hash_algorithm=objstore.DEFAULT_HASH_ALGORITHM
+    # 新对象的落盘压缩编码, None 为不压缩; 已有对象用 objstore.py -compress 转换
+    obj_compression=objstore.default_compression()
+    # 以内容 hash 寻址的响应 (GET /objects/hash[/文件名]) 的缓存时长, 0 为不缓存; /raw 的内容会随重新提交改变, 总是 no-cache
+    immutable_max_age=365*24*3600
+    objs=objstore.ObjectStore(DATA_OBJS_DIR, layout='sharded', algorithm=hash_algorithm, compression=obj_compression)
     db=db_module.DB(DB_PATH)
+    # /raw 用的 release 路径 -> hash 映射缓存, 以 (owner, projectname, githash) 为键
+    release_cache=cache.LRUCache(64*1024*1024, sizeof=cache.sizeof_str_map, shared=cache.SharedInvalidations(RELEASE_CACHE_GEN_PATH))
+    # /api/projects/<owner>/<projectname>/diff 的结果缓存, 以两个 release 的 id 为键 (重新提交后 id 改变, 不需要失效)
+    diff_cache=cache.LRUCache(16*1024*1024, sizeof=cache.sizeof_json)
+    # /checkFile 先用内存中的 Bloom filter 排除肯定不存在的 hash (一百万个 hash 约 6MB); 新 hash 多时更快, 见 bench.py -checkfile
+    # 运行时修改也生效: filter 在第一次用到时按当时的 c.db 建立 (见 filehash_filter())
+    checkfile_bloom=False
+    filehash_filter=None
+    # 启动时预先载入最近更新的多少个项目的最新 release 到 release_cache
+    warm_releases=200
+    # 后台对象 GC 的间隔秒数, 0 为不启动 (可改用 python objgc.py 定时执行); 宽限期内的对象视为上传中
+    gc_interval=0
+    gc_grace=objgc.DEFAULT_GRACE
+    gc_thread=None
+    # prefork.py 的 worker 进程数, None 为 CPU 核数; 收到 SIGTERM 后等待处理中请求完成的最长秒数
+    workers=None
+    shutdown_timeout=30
+    # 静态文件索引: 启动时载入 static/, ROOT_DIR 下的文件第一次请求时载入; 每个条目最多每 check_interval 秒 stat 一次
+    static_index=staticfiles.StaticIndex([STATIC_DIR, ROOT_DIR], ROOT_DIR, STATIC_CACHE_DIR, check_interval=1.0)
+    # 静态文件的缓存时长, 过期后凭 ETag 重新验证 (304); URL 带 ?v=<内容 hash> 时按 immutable_max_age 长期缓存
+    static_max_age=60
 
 def p(s):
     print(s)
@@ -35,32 +76,127 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
 @app.after_request
 def add_header(r):
+    # 自带缓存头的响应 (内容 hash 寻址的对象, 静态文件) 保持不变, 其余 (API 等可变内容) 一律不缓存
+    if 'Cache-Control' in r.headers:
+        return r
     r.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     r.headers['Pragma'] = 'no-cache'
     r.headers['Expires'] = '0'
     r.headers['Cache-Control'] = 'public, max-age=0'
     return r
 
-def is_sub(filename):
-    try:
-        base = os.path.realpath(ROOT_DIR)
-        return (os.path.realpath(filename) + os.sep).startswith(base + os.sep)
-    except:
-        return True
-
-def get_mimetype(path):
-    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
-
-def get_file(path):
-    if not os.path.isfile(path):
-        abort(404)
-        return None
-    if not is_sub(path):
-        abort(403)
-        return None
-    with open(path, 'rb') as f:
-        content = f.read()
-    return content 
+get_mimetype = staticfiles.get_mimetype
+
+is_valid_hash = objstore.is_valid_hash
+
+def upload_error(e):
+    if isinstance(e, objstore.HashMismatch):
+        return {'ret':c.hash_mismatch,'error':str(e)}
+    return {'ret':c.error_format,'error':str(e)}
+
+_TAR_BLOCK = 512
+
+def tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+def tar_padding(size):
+    return b'\0' * (-size % _TAR_BLOCK)
+
+def iter_tar_member(name, body, mtime=0):
+    yield tar_header(name, len(body), mtime)
+    yield body
+    yield tar_padding(len(body))
+
+def iter_tar_objects(hashes):
+    """
+    以 tar 流逐块产出 objs/<hash> 成员, 每次最多持有 obj_chunk_size 字节
+    不存在的 hash 跳过, 最后以 missing.json 成员列出
+    """
+    missing = []
+    for hashk in hashes:
+        obj = c.objs.locate(hashk)
+        try:
+            f = c.objs.open(obj) if obj else None
+            size = c.objs.size(obj) if obj else 0
+            mtime = os.stat(obj.path).st_mtime if obj else 0
+        except FileNotFoundError:
+            f = None
+        if f is None:
+            missing.append(hashk)
+            continue
+        with f:
+            yield tar_header('objs/' + hashk, size, mtime)
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(c.obj_chunk_size, remaining))
+                if not chunk:
+                    raise IOError('object truncated while streaming: ' + hashk)
+                remaining -= len(chunk)
+                yield chunk
+            yield tar_padding(size)
+    if missing:
+        yield from iter_tar_member('missing.json', json.dumps(missing).encode('utf-8'))
+    yield b'\0' * (_TAR_BLOCK * 2)
+
+def iter_tar_release(release, filehashmap, exclude):
+    """
+    release.json (不含 projectfile 的 release 条目, 带 filehashmap), projectfile/<文件名> 每个工程文件一个成员,
+    然后是 filehashmap 引用的对象, 按 hash 去重并跳过 exclude 中的
+    """
+    info = {k: v for k, v in release.items() if k != 'projectfile'}
+    info['filehashmap'] = filehashmap
+    yield from iter_tar_member('release.json', json.dumps(info, ensure_ascii=False).encode('utf-8'))
+    for name, doc in release['projectfile'].items():
+        yield from iter_tar_member('projectfile/' + name, json.dumps(doc, ensure_ascii=False).encode('utf-8'))
+    yield from iter_tar_objects(sorted(set(filehashmap.values()) - set(exclude)))
+
+def release_filehashmap(owner, projectname, githash):
+    """
+    release 的 filehashmap, 先查 c.release_cache; release 不存在时返回 None
+    """
+    def load():
+        releases = c.db.find_exact_match(githash, projectname, owner, fields=['filehashmap'])
+        return releases[0]['filehashmap'] if releases else None
+    return c.release_cache.get_or_load((owner, projectname, githash), load)
+
+def send_object(obj, mimetype='application/octet-stream', name=None, as_attachment=False, immutable=True):
+    """
+    发送对象内容, ETag 为内容 hash, 带 If-None-Match 命中时返回 304
+    压缩存放的对象在客户端接受该编码时原样发送并带 Content-Encoding,
+    否则边解压边发送, Range 按解压后的内容计算 (跳过 start 之前的部分)
+    name 为 Content-Disposition 中的文件名, 默认为对象 hash, 不暴露存储路径中的 .bin / .zst 文件名
+    immutable 时 (URL 以内容 hash 寻址, 内容不会变) c.immutable_max_age 非 0 则带 immutable 缓存头,
+    否则为 no-cache, 每次凭 ETag 重新验证
+    """
+    max_age = (c.immutable_max_age or None) if immutable else None
+    name = name or obj.hashk
+    if obj.encoding is None:
+        response = send_file(obj.path, mimetype=mimetype, download_name=name, as_attachment=as_attachment,
+                             conditional=True, etag=obj.hashk, max_age=max_age)
+    elif obj.encoding in request.accept_encodings:
+        response = send_file(obj.path, mimetype=mimetype, download_name=name, as_attachment=as_attachment,
+                             conditional=True, etag=f'{obj.hashk}-{obj.encoding}', max_age=max_age)
+        response.headers['Content-Encoding'] = obj.encoding
+    else:
+        size = c.objs.size(obj)
+        f = c.objs.open(obj)
+        try:
+            response = send_file(f, mimetype=mimetype, download_name=name, as_attachment=as_attachment,
+                                 conditional=False, etag=obj.hashk, max_age=max_age)
+            response.content_length = size
+            # 文件对象不带长度, 由这里给出解压后的长度处理 Range (206 / 416) 与 If-None-Match
+            response = response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+        except Exception:
+            f.close()
+            raise
+    if max_age:
+        response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
 
 def parse_pagination(args):
     default_size = 20
@@ -95,35 +231,87 @@ def parse_pagination(args):
         offset = start
     return offset, limit
 
+def encode_cursor(key):
+    if key is None:
+        return None
+    return str(base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')), encoding='utf-8')
+
+def parse_keyset(args):
+    """
+    只有游标分页的接口: 没有 cursor 参数或为空时为第一页
+    返回 (after, limit), after 为上一页 next_cursor 解码出的列表或 None
+    """
+    default_size = 20
+    try:
+        size = int(args.get('size')) if args.get('size') is not None else default_size
+    except:
+        size = default_size
+    limit = size if size > 0 else default_size
+    token = args.get('cursor')
+    if not token:
+        return None, limit
+    return json.loads(base64.urlsafe_b64decode(token.encode('utf-8'))), limit
+
+def parse_cursor(args):
+    """
+    游标分页参数: 没有 cursor 参数时返回 None, 走旧的 page/size/start/end 分页
+    cursor 为空字符串表示游标模式的第一页; 否则为上一页返回的 next_cursor
+    返回 (after, limit), after 为 (time, id) 或 None
+    """
+    if 'cursor' not in args:
+        return None
+    after, limit = parse_keyset(args)
+    if after is None:
+        return None, limit
+    time, rowid = after
+    return (time, int(rowid)), limit
+
+def parse_fields(args):
+    """
+    ?fields=githash,author,time 只返回指定字段; 未指定时返回 None, 即完整条目
+    """
+    fields = args.get('fields')
+    if not fields:
+        return None
+    return [f.strip() for f in fields.split(',') if f.strip()]
+
+def want_total(args):
+    return args.get('total') in ('1', 'true')
+
 @app.route('/', methods=['GET'])
 def root():
     return static_file('index.html')
 
 @app.route('/<path:path>', methods=['GET'])
 def static_file(path):
-    primary_path = os.path.join(STATIC_DIR, path)
-    if os.path.isdir(primary_path):
-        if not primary_path.endswith(os.sep):
-            primary_path = primary_path + os.sep
-        primary_path = os.path.join(primary_path, 'index.html')
-
-    target_path = primary_path
-
-    if not os.path.isfile(target_path):
-        fallback_path = os.path.join(ROOT_DIR, path)
-        if os.path.isdir(fallback_path):
-            if not fallback_path.endswith(os.sep):
-                fallback_path = fallback_path + os.sep
-            fallback_path = os.path.join(fallback_path, 'index.html')
-        if os.path.isfile(fallback_path):
-            target_path = fallback_path
-        else:
-            abort(404)
-            return None
-
-    mimetype = get_mimetype(target_path)
-    response = Response(get_file(target_path), mimetype = mimetype)
-    if mimetype.startswith('audio/'): response.headers['Accept-Ranges'] = 'bytes'
+    entry = c.static_index.lookup(path)
+    if entry is None:
+        abort(404)
+        return None
+    # send_file 把打开的文件交给 wsgi.file_wrapper, 支持的服务器 (gunicorn, uwsgi) 用 sendfile 发送; 支持 Range
+    versioned = request.args.get('v') == entry.etag and c.immutable_max_age
+    max_age = c.immutable_max_age if versioned else c.static_max_age
+    name = os.path.basename(entry.path)
+    response = None
+    for encoding, (variant_path, size) in entry.variants.items():
+        if encoding in request.accept_encodings:
+            try:
+                response = send_file(variant_path, mimetype=entry.mimetype, download_name=name, conditional=True, etag=f'{entry.etag}-{encoding}', max_age=max_age, last_modified=entry.mtime_ns / 1e9)
+            except FileNotFoundError:
+                # 文件已变化, 另一个 worker 删除了旧的压缩文件; 本进程在 check_interval 内也会发现
+                break
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = send_file(entry.path, mimetype=entry.mimetype, download_name=name, conditional=True, etag=entry.etag, max_age=max_age, last_modified=entry.mtime_ns / 1e9)
+    response.cache_control.public = True
+    response.cache_control.no_cache = None
+    response.cache_control.max_age = max_age
+    if versioned:
+        response.cache_control.immutable = True
+    # 压缩版本还在后台生成时也带上, 以免缓存把不压缩的响应当作所有客户端通用
+    if staticfiles.has_variants(entry):
+        response.vary.add('Accept-Encoding')
     return response
 
 @app.route('/checkFile', methods=['POST'])
@@ -132,7 +320,12 @@ def checkFile():
     data = str(data, encoding = 'utf-8')
     try:
         filehashes=json.loads(data)
-        ret={'ret':'','hashes': c.db.find_matching_filehash(filehashes)}
+        known=filehash_filter()
+        if known is not None:
+            hashes=known.find_matching(filehashes)
+        else:
+            hashes=c.db.find_matching_filehash(filehashes)
+        ret={'ret':'','hashes': hashes}
     except Exception as e:
         return {'ret':c.error_format,'error':str(e)}
     return ret
@@ -145,13 +338,21 @@ def submitFile():
         filehash64Map=json.loads(data)
         filehashes=[]
         for hashk in filehash64Map:
-            filehashes.append(hashk)
+            if not is_valid_hash(hashk):
+                return {'ret':c.invalid_hash,'error':hashk}
+        for hashk in filehash64Map:
             filehash64=filehash64Map[hashk]
-            with open(os.path.join(DATA_OBJS_DIR, hashk + '.bin'), 'wb') as f:
-                f.write(base64.b64decode(filehash64))
+            tmp = c.objs.open_tmp()
+            try:
+                tmp.write(base64.b64decode(filehash64))
+                c.objs.commit(tmp, hashk)
+            except:
+                tmp.discard()
+                raise
+            filehashes.append(hashk)
         c.db.add_filehash(filehashes)
     except Exception as e:
-        return {'ret':c.error_format,'error':str(e)}
+        return upload_error(e)
     return {'ret':''}
 
 # /downloadFile [hashes] -> {hashes:bin64} null代表不存在
@@ -163,9 +364,9 @@ def downloadFile():
         filehashes=json.loads(data)
         retmap={}
         for hashk in filehashes:
-            filepath=os.path.join(DATA_OBJS_DIR, hashk + '.bin')
-            if os.path.isfile(filepath):
-                with open(filepath, 'rb') as f:
+            obj=c.objs.locate(hashk)
+            if obj:
+                with c.objs.open(obj) as f:
                     filebin=f.read()
                     filebin64=base64.b64encode(filebin)
                     retmap[hashk]=str(filebin64, encoding='utf-8')
@@ -175,6 +376,94 @@ def downloadFile():
     except Exception as e:
         return {'ret':c.error_format,'error':str(e)}
 
+# PUT /objects/<hash> 请求体即文件本体, 分块写入临时文件后原子改名
+@app.route('/objects/<hashk>', methods=['PUT'])
+def putObject(hashk):
+    if not is_valid_hash(hashk):
+        return {'ret':c.invalid_hash,'error':hashk}
+    try:
+        tmp = c.objs.open_tmp()
+        try:
+            shutil.copyfileobj(request.stream, tmp, c.obj_chunk_size)
+            c.objs.commit(tmp, hashk)
+        except:
+            tmp.discard()
+            raise
+        c.db.add_filehash([hashk])
+    except Exception as e:
+        return upload_error(e)
+    return {'ret':'', 'hashes': [hashk]}
+
+# POST /objects multipart/form-data, 每个文件 part 的字段名为 hash, 各 part 直接流式写入 objs 下的临时文件
+@app.route('/objects', methods=['POST'])
+def postObjects():
+    tmps = []
+    try:
+        _, _, files = parse_form_data(request.environ, stream_factory=c.objs.open_tmp)
+        parts = list(files.items(multi=True))
+        tmps = [part.stream for _, part in parts]
+        for hashk, _ in parts:
+            if not is_valid_hash(hashk):
+                return {'ret':c.invalid_hash,'error':hashk}
+        hashes = []
+        for hashk, part in parts:
+            c.objs.commit(part.stream, hashk)
+            hashes.append(hashk)
+        c.db.add_filehash(hashes)
+    except Exception as e:
+        return upload_error(e)
+    finally:
+        for tmp in tmps:
+            if os.path.exists(tmp.name):
+                tmp.discard()
+    return {'ret':'', 'hashes': hashes}
+
+# GET /objects/<hash> 单个对象, 支持 Range / If-None-Match, ETag 即内容 hash
+@app.route('/objects/<hashk>', methods=['GET'])
+def getObject(hashk):
+    obj = c.objs.locate(hashk)
+    if not obj:
+        abort(404)
+    return send_object(obj)
+
+# GET /objects/<hash>/<filename> 同上, 按 filename 的扩展名给出 Content-Type, 供前端以 hash 直接引用文件
+@app.route('/objects/<hashk>/<path:filename>', methods=['GET'])
+def getNamedObject(hashk, filename):
+    obj = c.objs.locate(hashk)
+    if not obj:
+        abort(404)
+    return send_object(obj, get_mimetype(filename), os.path.basename(filename), request.args.get('download') == '1')
+
+# POST /objects/bundle [hashes] -> tar 流, 成员为 objs/<hash>, 缺失的 hash 列在 missing.json
+@app.route('/objects/bundle', methods=['POST'])
+def bundleObjects():
+    data = request.get_data()
+    data = str(data, encoding = 'utf-8')
+    try:
+        filehashes=json.loads(data)
+    except Exception as e:
+        return {'ret':c.error_format,'error':str(e)}
+    return Response(iter_tar_objects(filehashes), mimetype='application/x-tar')
+
+# GET /releases/<owner>/<projectname>/<githash>/bundle[?exclude=hash,hash] 或 POST 同一路径 {exclude: [hashes]}
+# -> tar 流: release.json, projectfile/<文件名>, objs/<hash> (去重, 跳过 exclude 中客户端已有的), missing.json
+@app.route('/releases/<owner>/<projectname>/<githash>/bundle', methods=['GET', 'POST'])
+def bundleRelease(owner, projectname, githash):
+    try:
+        if request.method == 'POST':
+            exclude = json.loads(str(request.get_data(), encoding = 'utf-8') or '{}').get('exclude', [])
+        else:
+            exclude = [h for h in request.args.get('exclude', '').split(',') if h]
+        releases = c.db.find_exact_match(githash, projectname, owner, fields=['githash', 'projectname', 'owner', 'author', 'projectfile', 'time', 'parents'])
+        filehashmap = release_filehashmap(owner, projectname, githash)
+    except Exception as e:
+        return {'ret':c.error_format,'error':str(e)}
+    if not releases or filehashmap is None:
+        abort(404)
+    response = Response(iter_tar_release(releases[0], filehashmap, exclude), mimetype='application/x-tar')
+    response.headers['Content-Disposition'] = 'attachment; filename="%s-%s.tar"' % (projectname, githash)
+    return response
+
 @app.route('/deleteRelease', methods=['POST'])
 def deleteRelease():
     data = request.get_data()
@@ -182,6 +471,8 @@ def deleteRelease():
     try:
         info=json.loads(data)
         count=c.db.delete_release(info['githash'], info['projectname'], info['owner'])
+        if count:
+            c.release_cache.invalidate((info['owner'], info['projectname'], info['githash']))
     except Exception as e:
         return {'ret':c.error_format,'error':str(e)}
     return {'ret':'', 'count': count}
@@ -192,7 +483,7 @@ def queryRelease():
     data = str(data, encoding = 'utf-8')
     try:
         info=json.loads(data)
-        rows=c.db.find_exact_match(info['githash'], info['projectname'], info['owner'])
+        rows=c.db.find_exact_match(info['githash'], info['projectname'], info['owner'], fields=info.get('fields'))
         retlist=[]
         for row in rows:
             retlist.append(row)
@@ -201,17 +492,54 @@ def queryRelease():
     return {'ret':'', 'releases': retlist}
 
 #/submitRelease {git hash, hash map, 工程文件一共4个json, 日期, owner, projectname, commiter} -> {count,files} 覆盖的条目数, 文件缺失
+# 带 parent (同一项目下的 githash) 时为增量提交: filehashmap / projectfile 为相对 parent 的 JSON merge patch, null 表示删除
+# 可选 parents: 父提交 githash 列表, 增量提交时默认为 [parent]
 @app.route('/submitRelease', methods=['POST'])
 def submitRelease():
     data = request.get_data()
     data = str(data, encoding = 'utf-8')
     try:
         info=json.loads(data)
-        count,files=c.db.submit_release(info['githash'], info['projectname'], info['owner'], info['author'], info['filehashmap'], info['projectfile'], info['time'])
+        parents=info.get('parents')
+        if parents is not None and not (isinstance(parents, list) and all(isinstance(x, str) for x in parents)):
+            raise ValueError('parents must be a list of githash')
+        if info.get('parent') is not None:
+            filehashmap=info.get('filehashmap', {})
+            projectfile=info.get('projectfile', {})
+            if not isinstance(filehashmap, dict) or not isinstance(projectfile, dict):
+                raise ValueError('filehashmap and projectfile must be objects')
+            count,files=c.db.submit_release_delta(info['githash'], info['projectname'], info['owner'], info['author'], info['parent'], filehashmap, projectfile, info['time'], parents)
+        else:
+            count,files=c.db.submit_release(info['githash'], info['projectname'], info['owner'], info['author'], info['filehashmap'], info['projectfile'], info['time'], parents)
+        # release_cache 不缓存不存在的 release, 首次提交不必失效; 共享失效要清空所有进程的缓存
+        if count:
+            c.release_cache.invalidate((info['owner'], info['projectname'], info['githash']))
     except Exception as e:
         return {'ret':c.error_format,'error':str(e)}
     return {'ret':'', 'count': count, 'files': files}
 
+#/mergeRelease {releases: [{owner, projectname, githash}, ...], target?: {githash, projectname, owner, author, time}} -> {filehashmap, projectfile, conflicts[, count]}
+# 合并拉取, releases 中靠后的优先; 带 target 时把结果提交为新 release, parents 为各来源的 githash
+@app.route('/mergeRelease', methods=['POST'])
+def mergeRelease():
+    data = request.get_data()
+    data = str(data, encoding = 'utf-8')
+    try:
+        info=json.loads(data)
+        sources=[(r['owner'], r['projectname'], r['githash']) for r in info['releases']]
+        if len(sources) < 2:
+            raise ValueError('at least two releases are required')
+        target=info.get('target')
+        if target is None:
+            merged=c.db.merge_releases(sources)
+        else:
+            merged=c.db.submit_merge(sources, target['githash'], target['projectname'], target['owner'], target['author'], target['time'])
+            if merged['count']:
+                c.release_cache.invalidate((target['owner'], target['projectname'], target['githash']))
+    except Exception as e:
+        return {'ret':c.error_format,'error':str(e)}
+    return dict(merged, ret='')
+
 @app.route('/api/owners', methods=['GET'])
 def listOwners():
     try:
@@ -223,6 +551,14 @@ def listOwners():
 @app.route('/api/projects', methods=['GET'])
 def listProjects():
     try:
+        keyset = parse_cursor(request.args)
+        if keyset is not None:
+            after, limit = keyset
+            projects, next_key = c.db.list_projects_global_after(after, limit)
+            ret = {'ret':'', 'projects': projects, 'next_cursor': encode_cursor(next_key), 'limit': limit}
+            if want_total(request.args):
+                ret['total'] = c.db.count_projects_global()
+            return ret
         offset, limit = parse_pagination(request.args)
         total = c.db.count_projects_global()
         projects = c.db.list_projects_global(offset, limit)
@@ -233,6 +569,14 @@ def listProjects():
 @app.route('/api/owners/<owner>/projects', methods=['GET'])
 def listProjectsByOwner(owner):
     try:
+        keyset = parse_cursor(request.args)
+        if keyset is not None:
+            after, limit = keyset
+            projects, next_key = c.db.list_projects_by_owner_after(owner, after, limit)
+            ret = {'ret':'', 'projects': projects, 'next_cursor': encode_cursor(next_key), 'limit': limit}
+            if want_total(request.args):
+                ret['total'] = c.db.count_projects_by_owner(owner)
+            return ret
         offset, limit = parse_pagination(request.args)
         total = c.db.count_projects_by_owner(owner)
         projects = c.db.list_projects_by_owner(owner, offset, limit)
@@ -243,17 +587,55 @@ def listProjectsByOwner(owner):
 @app.route('/api/projects/<owner>/<projectname>/commits', methods=['GET'])
 def listCommits(owner, projectname):
     try:
+        keyset = parse_cursor(request.args)
+        if keyset is not None:
+            after, limit = keyset
+            commits, next_key = c.db.list_commits_after(owner, projectname, after, limit, fields=parse_fields(request.args))
+            ret = {'ret':'', 'commits': commits, 'next_cursor': encode_cursor(next_key), 'limit': limit}
+            if want_total(request.args):
+                ret['total'] = c.db.count_commits(owner, projectname)
+            return ret
         offset, limit = parse_pagination(request.args)
         total = c.db.count_commits(owner, projectname)
-        commits = c.db.list_commits(owner, projectname, offset, limit)
+        commits = c.db.list_commits(owner, projectname, offset, limit, fields=parse_fields(request.args))
         return {'ret':'', 'commits': commits, 'total': total, 'offset': offset, 'limit': limit}
     except Exception as e:
         return {'ret':c.error_format,'error':str(e)}
 
+# GET /api/projects/<owner>/<projectname>/diff?from=<githash>&to=<githash> 两个提交之间新增 / 删除 / 改变的路径, 以及工程文件中改变的键
+@app.route('/api/projects/<owner>/<projectname>/diff', methods=['GET'])
+def diffCommits(owner, projectname):
+    try:
+        if not request.args.get('from') or not request.args.get('to'):
+            raise ValueError('from and to are required')
+        ids = []
+        for githash in (request.args['from'], request.args['to']):
+            releases = c.db.find_exact_match(githash, projectname, owner, fields=['id'])
+            if not releases:
+                return {'ret':c.error_format,'error':f'release not found: {owner}/{projectname}/{githash}'}
+            ids.append(releases[-1]['id'])
+        diff = c.diff_cache.get_or_load(tuple(ids), lambda: c.db.diff_releases(ids[0], ids[1]))
+    except Exception as e:
+        return {'ret':c.error_format,'error':str(e)}
+    return dict(diff, ret='', **{'from': request.args['from'], 'to': request.args['to']})
+
+# GET /api/projects/<owner>/<projectname>/history/<path>?cursor=&size=[&changes=1] 各提交中该路径的 filehash, 新提交在前
+# 不含该路径的提交 filehash 为 null; changes=1 时只返回该路径内容出现 / 改变 / 删除的提交
+@app.route('/api/projects/<owner>/<projectname>/history/<path:filepath>', methods=['GET'])
+def pathHistory(owner, projectname, filepath):
+    try:
+        after, limit = parse_keyset(request.args)
+        if after is not None:
+            after = (after[0], int(after[1]))
+        history, next_key = c.db.list_path_history(owner, projectname, filepath, after, limit, changes_only=request.args.get('changes') in ('1', 'true'))
+    except Exception as e:
+        return {'ret':c.error_format,'error':str(e)}
+    return {'ret':'', 'history': history, 'next_cursor': encode_cursor(next_key), 'limit': limit}
+
 @app.route('/api/projects/<owner>/<projectname>/<githash>', methods=['GET'])
 def getCommit(owner, projectname, githash):
     try:
-        releases = c.db.find_exact_match(githash, projectname, owner)
+        releases = c.db.find_exact_match(githash, projectname, owner, fields=parse_fields(request.args))
         if not releases:
             abort(404)
         # return the first match while still reporting duplicates count if any
@@ -261,30 +643,73 @@ def getCommit(owner, projectname, githash):
     except Exception as e:
         return {'ret':c.error_format,'error':str(e)}
 
+_filehash_filter_lock = threading.Lock()
+
+def filehash_filter():
+    """
+    c.checkfile_bloom 为 True 时返回 /checkFile 用的 Bloom filter, 不存在或 c.db 已被替换时新建; 否则返回 None
+    """
+    if not c.checkfile_bloom:
+        return None
+    with _filehash_filter_lock:
+        if c.filehash_filter is None or c.filehash_filter.db is not c.db:
+            c.filehash_filter = cache.KnownHashFilter(c.db)
+        return c.filehash_filter
+
+def warm_caches():
+    """
+    接受请求前预热: 载入最近更新项目的最新 release 的 filehashmap 与 /checkFile 的 Bloom filter, 并让常用查询的页进入 SQLite 页缓存
+    """
+    c.db.count_projects_global()
+    c.db.list_owners()
+    c.static_index.preload()
+    known = filehash_filter()
+    if known is not None:
+        known.refresh()
+    for project in c.db.list_projects_global(0, c.warm_releases):
+        release_filehashmap(project['owner'], project['projectname'], project['githash'])
+
+# GET /api/objects/<hash>/releases?cursor=&size= 引用该对象的 release 与路径, 新提交在前
+@app.route('/api/objects/<hashk>/releases', methods=['GET'])
+def objectReleases(hashk):
+    try:
+        after, limit = parse_keyset(request.args)
+        if after is not None:
+            after = (int(after[0]), after[1])
+        releases, next_key = c.db.list_filehash_releases(hashk, after, limit)
+    except Exception as e:
+        return {'ret':c.error_format,'error':str(e)}
+    return {'ret':'', 'releases': releases, 'next_cursor': encode_cursor(next_key), 'limit': limit}
+
+# GET /api/stats 进程内缓存的命中统计与最近一轮后台 GC 的结果
+@app.route('/api/stats', methods=['GET'])
+def getStats():
+    gc_report = c.gc_thread.last_report if c.gc_thread else None
+    return {'ret':'', 'release_cache': c.release_cache.stats(), 'diff_cache': c.diff_cache.stats(), 'static': c.static_index.stats(), 'gc': gc_report}
+
 @app.route('/raw/<owner>/<projectname>/<githash>/<path:filepath>', methods=['GET'])
 def serveRaw(owner, projectname, githash, filepath):
     try:
-        releases = c.db.find_exact_match(githash, projectname, owner)
-        if not releases:
+        filehashmap = release_filehashmap(owner, projectname, githash)
+        if filehashmap is None:
             abort(404)
-        release = releases[0]
-        filehashmap = release.get('filehashmap', {})
         if filepath not in filehashmap:
             abort(404)
         hashk = filehashmap[filepath]
-        binpath = os.path.join(DATA_OBJS_DIR, hashk + '.bin')
-        if not os.path.isfile(binpath):
+        obj = c.objs.locate(hashk)
+        if not obj:
             abort(404)
-        content = get_file(binpath)
-        mimetype = get_mimetype(filepath)
-        response = Response(content, mimetype=mimetype)
-        if request.args.get('download') == '1':
-            response.headers['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(filepath)
-        return response
+        # 同一 githash 可以重新提交, 路径对应的内容会变, 不能 immutable
+        return send_object(obj, get_mimetype(filepath), os.path.basename(filepath), request.args.get('download') == '1', immutable=False)
     except Exception as e:
         return {'ret':c.error_format,'error':str(e)}
 
 if __name__ == '__main__':
     os.chdir(ROOT_DIR)
+    c.db.init_db_once(INIT_LOCK_PATH)
+    warm_caches()
+    if c.gc_interval:
+        c.gc_thread = objgc.GCThread(c.db, c.objs, c.gc_interval, c.gc_grace)
+        c.gc_thread.start()
     p('服务已启动...')
     app.run(host = c.ip, port = c.port, debug = False)
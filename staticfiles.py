@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+静态文件 (前端页面与 data-flow-graph-node 等同级目录) 的内存索引
+
+URL 路径第一次被请求时解析出实际文件 (先 static/, 再 ROOT_DIR; 目录取 index.html) 并记入索引,
+之后的请求直接命中, 每隔 check_interval 秒才 stat 一次文件, mtime 或大小变化时重建该条目
+static/ 在启动时整体预先载入
+每个条目带内容 hash 作为 ETag; 可压缩的文本类文件预先压缩为 gzip / br (需要安装 brotli),
+按内容 hash 存放在 cache_dir 下, 重启后不必重新压缩
+请求中第一次载入或发现变化的文件先以 mtime 与大小作 ETag、不带压缩版本提供,
+计算 hash 与压缩交给后台线程, 完成后替换条目; 文件变化后不再被引用的旧压缩文件随之删除
+"""
+
+import os
+import gzip
+import time
+import hashlib
+import mimetypes
+import posixpath
+import queue
+import threading
+from collections import namedtuple
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 按优先顺序: 客户端同时接受时发送更小的 br
+ENCODING_SUFFIXES = (
+    ('br', '.br'),
+    ('gzip', '.gz'),
+)
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MAX_SIZE = 16 * 1024 * 1024
+COMPRESS_MAX_RATIO = 0.9
+# 超过这个大小的文件不计算内容 hash, ETag 由 mtime 与大小组成
+HASH_MAX_SIZE = 64 * 1024 * 1024
+_COMPRESSIBLE_TYPES = ('application/javascript', 'application/json', 'application/xml', 'image/svg+xml', 'application/wasm')
+
+# path 为磁盘上的原始文件, variants 为 {编码: (路径, 大小)}
+StaticEntry = namedtuple('StaticEntry', ['path', 'size', 'mtime_ns', 'etag', 'mimetype', 'variants'])
+
+
+def get_mimetype(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def is_compressible(mimetype: str) -> bool:
+    return mimetype.startswith('text/') or mimetype in _COMPRESSIBLE_TYPES
+
+
+def has_variants(entry: StaticEntry) -> bool:
+    """
+    条目是否 (将会) 带压缩版本, 即响应是否随 Accept-Encoding 变化
+    """
+    return is_compressible(entry.mimetype) and COMPRESS_MIN_SIZE <= entry.size <= COMPRESS_MAX_SIZE
+
+
+def _file_hash(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _compress(encoding: str, data: bytes) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+class StaticIndex:
+    def __init__(self, roots: List[str], base: str, cache_dir: str, check_interval: float = 1.0, preload: int = 1):
+        """
+        roots 按顺序查找; base 为允许访问的根目录, 解析后 (跟随符号链接) 不在其下的文件不提供
+        前 preload 个根目录在 preload() 时整体载入
+        """
+        self.roots = roots
+        self.base = os.path.realpath(base)
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self.preload_roots = roots[:preload]
+        # URL 路径 -> (StaticEntry, 上次检查的时间)
+        self._entries: Dict[str, Tuple[StaticEntry, float]] = {}
+        self._lock = threading.Lock()
+        # 等待后台计算 hash 与压缩的 URL 路径
+        self._queue: 'queue.Queue[str]' = queue.Queue()
+        self._pending = set()
+        # URL 路径 -> 变化前带压缩版本的条目, 新内容的 hash 算出后确认不同才删除其压缩文件 (只是 touch 时保留)
+        self._replaced: Dict[str, StaticEntry] = {}
+        self._worker = None
+        self.hits = 0
+        self.builds = 0
+        self.pruned = 0
+
+    def _find(self, path: str) -> Optional[str]:
+        for root in self.roots:
+            target = os.path.join(root, path)
+            if os.path.isdir(target):
+                target = os.path.join(target, 'index.html')
+            if os.path.isfile(target):
+                return target
+        return None
+
+    def _variants(self, path: str, etag: str, size: int, mimetype: str) -> Dict[str, Tuple[str, int]]:
+        if not is_compressible(mimetype) or not COMPRESS_MIN_SIZE <= size <= COMPRESS_MAX_SIZE:
+            return {}
+        data = None
+        variants = {}
+        for encoding, suffix in ENCODING_SUFFIXES:
+            if encoding == 'br' and brotli is None:
+                continue
+            variant_path = os.path.join(self.cache_dir, etag + suffix)
+            if not os.path.exists(variant_path):
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = _compress(encoding, data)
+                if len(compressed) > size * COMPRESS_MAX_RATIO:
+                    continue
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # 多个 worker 可能同时生成同一个文件, 写临时文件后原子改名
+                tmp_path = f'{variant_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(compressed)
+                os.replace(tmp_path, variant_path)
+            variants[encoding] = (variant_path, os.path.getsize(variant_path))
+        return variants
+
+    def _build(self, path: str, full: bool) -> Optional[StaticEntry]:
+        """
+        full 为 False 时只 stat, ETag 由 mtime 与大小组成且不带压缩版本, 之后由 _complete 补全
+        """
+        target = self._find(path)
+        if target is None:
+            return None
+        real = os.path.realpath(target)
+        if not (real + os.sep).startswith(self.base + os.sep):
+            return None
+        try:
+            st = os.stat(real)
+            mimetype = get_mimetype(target)
+            if full and st.st_size <= HASH_MAX_SIZE:
+                etag = _file_hash(real)
+                variants = self._variants(real, etag, st.st_size, mimetype)
+            else:
+                etag = f'{st.st_mtime_ns:x}-{st.st_size:x}'
+                variants = {}
+        except FileNotFoundError:
+            # 解析后被删除
+            return None
+        self.builds += 1
+        return StaticEntry(real, st.st_size, st.st_mtime_ns, etag, mimetype, variants)
+
+    def _prune(self, old: StaticEntry):
+        # 调用方持有 self._lock; 同一内容可能被多个 URL 路径 (目录与其 index.html) 引用
+        if not old.variants or any(entry.etag == old.etag for entry, _ in self._entries.values()):
+            return
+        for variant_path, _ in old.variants.values():
+            try:
+                os.unlink(variant_path)
+                self.pruned += 1
+            except FileNotFoundError:
+                pass
+
+    def _store(self, key: str, entry: Optional[StaticEntry], now: float, old: Optional[StaticEntry], complete: bool, expect: Optional[StaticEntry] = None):
+        """
+        complete: entry 已是最终结果 (hash 与压缩版本已算出, 或文件太大不需要), 此时才能判断旧压缩文件是否还有用
+        expect 不为空时, 只在当前条目仍为 expect 时写入
+        """
+        with self._lock:
+            if expect is not None and self._entries.get(key, (None,))[0] is not expect:
+                return
+            if entry is None:
+                # 不存在的路径不记入索引, 任意 URL 不会让索引无限增长
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = (entry, now)
+            if old is not None and old.variants:
+                self._replaced.setdefault(key, old)
+            if entry is None or complete:
+                old = self._replaced.pop(key, None)
+                if old is not None and (entry is None or entry.etag != old.etag):
+                    self._prune(old)
+
+    def _schedule(self, key: str):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='static-index', daemon=True)
+                self._worker.start()
+        self._queue.put(key)
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            # 先移出, 计算期间文件再次变化时 lookup 可以重新安排
+            with self._lock:
+                self._pending.discard(key)
+            try:
+                self._complete(key)
+            except Exception as e:
+                print(f'static index: {key}: {e}', flush=True)
+
+    def _complete(self, key: str):
+        """
+        后台线程中计算 hash 与压缩版本; 期间文件又被修改或条目已被替换时放弃, 由下一次 lookup 重新安排
+        """
+        cached = self._entries.get(key)
+        if cached is None:
+            return
+        entry = self._build(key, full=True)
+        if entry is None or (entry.path, entry.mtime_ns, entry.size) != (cached[0].path, cached[0].mtime_ns, cached[0].size):
+            return
+        self._store(key, entry, cached[1], None, True, expect=cached[0])
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        """
+        规范化 URL 路径作为索引键: 同一文件的不同写法 (a/./b, a/../a/b) 只占一个条目, .. 不会跳出根目录
+        """
+        return posixpath.normpath('/' + path.replace('\\', '/')).lstrip('/')
+
+    def lookup(self, path: str) -> Optional[StaticEntry]:
+        key = self.normalize(path)
+        now = time.monotonic()
+        cached = self._entries.get(key)
+        if cached is not None:
+            entry, checked = cached
+            if now - checked < self.check_interval:
+                self.hits += 1
+                return entry
+            try:
+                st = os.stat(entry.path)
+                if st.st_mtime_ns == entry.mtime_ns and st.st_size == entry.size:
+                    with self._lock:
+                        # 后台线程可能刚刚换上了算好 hash 的条目, 不能用读到的旧条目覆盖
+                        current = self._entries.get(key)
+                        if current is not None and current[0] is entry:
+                            self._entries[key] = (entry, now)
+                        elif current is not None:
+                            entry = current[0]
+                    self.hits += 1
+                    return entry
+            except FileNotFoundError:
+                pass
+        old = cached[0] if cached is not None else None
+        entry = self._build(key, full=False)
+        complete = entry is None or entry.size > HASH_MAX_SIZE
+        self._store(key, entry, now, old, complete)
+        if not complete:
+            self._schedule(key)
+        return entry
+
+    def _preload_one(self, key: str):
+        old = self._entries.get(key)
+        self._store(key, self._build(key, full=True), time.monotonic(), old[0] if old is not None else None, True)
+
+    def preload(self):
+        """
+        启动时 (接受请求之前) 在调用线程中完整载入, 包括 hash 与压缩版本
+        """
+        for root in self.preload_roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    rel = os.path.relpath(os.path.join(dirpath, name), root).replace(os.sep, '/')
+                    self._preload_one(self.normalize(rel))
+                    if name == 'index.html':
+                        self._preload_one(self.normalize(posixpath.dirname(rel)))
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._entries), 'hits': self.hits, 'builds': self.builds, 'pending': len(self._pending), 'pruned': self.pruned}